@@ -1,12 +1,22 @@
-from fastapi import FastAPI, File, UploadFile, Form, Request, HTTPException, Depends
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, File, UploadFile, Form, Request, HTTPException, Depends, BackgroundTasks
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import os
+import hashlib
+import json
+import math
 import requests
 import uuid
 import pymongo
 from datetime import datetime
+from functools import lru_cache
+from starlette.concurrency import run_in_threadpool
+
+from app.ml_router import get_ml_router
+from app.progress import TERMINAL_STAGES, ProgressHub, sse_stream
+from app.rate_limit import SingleFlight, StreamSingleFlight, limiter_from_env
+from app.write_buffer import BufferFullError, buffer_from_env
 
 # Create the FastAPI app
 app = FastAPI(title="Resume Analyzer API")
@@ -35,6 +45,62 @@ def get_database():
     db = mongo_client["resume_analyzer"]
     return db
 
+@lru_cache(maxsize=None)
+def get_write_buffer():
+    """Process-wide write-behind buffer for resume and analysis inserts"""
+    return buffer_from_env(get_database())
+
+@lru_cache(maxsize=None)
+def get_rate_limiter():
+    """Process-wide per-email / per-IP upload rate limiter"""
+    return limiter_from_env(get_database)
+
+# Concurrent uploads of the same document share one ML call
+ml_single_flight = SingleFlight()
+ml_stream_flight = StreamSingleFlight()
+
+# Stage-by-stage progress of analyses started through /api/upload
+progress_hub = ProgressHub()
+
+@app.on_event("shutdown")
+def flush_write_buffer():
+    """Write any buffered documents before the process exits"""
+    if get_write_buffer.cache_info().currsize:
+        get_write_buffer().close()
+
+async def check_rate_limit(request, rate_limiter, email):
+    """Raise 429 if the uploader's email or IP has run out of upload tokens"""
+    client_ip = request.client.host if request.client else None
+    # The Mongo bucket store blocks, so keep it off the event loop
+    retry_after = await run_in_threadpool(rate_limiter.check, email=email.strip().lower(), ip=client_ip)
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many uploads, please try again later",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+
+def store_analysis(write_buffer, resume_id, name, email, filename, analysis_results):
+    """Queue resume metadata and analysis results; they are written in batches"""
+    # Queued together so a full buffer never leaves a resume without its analysis
+    write_buffer.add_many([("resumes", {
+        "id": resume_id,
+        "name": name,
+        "email": email,
+        "filename": filename,
+        "upload_date": datetime.utcnow()
+    }), ("analyses", {
+        "resume_id": resume_id,
+        "match_score": analysis_results.get("match_score", 0),
+        "skills_identified": analysis_results.get("skills_identified", []),
+        "missing_skills": analysis_results.get("missing_skills", []),
+        "recommendations": analysis_results.get("recommendations", []),
+        # Kept as the training corpus for app.training in ml_matcher
+        "predicted_labels": analysis_results.get("predicted_labels", []),
+        "token_counts": analysis_results.get("token_counts", {}),
+        "analysis_date": datetime.utcnow()
+    })])
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     """Render the main page"""
@@ -49,60 +115,38 @@ async def read_root(request: Request):
 async def upload_resume(
     request: Request,
     db=Depends(get_database),
+    ml_router=Depends(get_ml_router),
+    write_buffer=Depends(get_write_buffer),
+    rate_limiter=Depends(get_rate_limiter),
     name: str = Form(...),
     email: str = Form(...),
     resume: UploadFile = File(...)
 ):
     """Handle file upload and analyze"""
+    # Reject before reading the file so a flood of uploads costs as little as possible
+    await check_rate_limit(request, rate_limiter, email)
+    
     try:
         # Generate a unique ID for this resume
         resume_id = str(uuid.uuid4())
         
-        # Save the file temporarily
-        file_location = f"/tmp/{resume_id}_{resume.filename}"
-        with open(file_location, "wb+") as file_object:
-            file_object.write(await resume.read())
-        
-        # Prepare the file to be sent to the ML service
-        with open(file_location, "rb") as f:
-            files = {"resume": (resume.filename, f, resume.content_type)}
-            form_data = {"resume_id": resume_id}
-            
-            # Send to ML service
-            ml_service_url = os.environ.get("ML_API_URL", "http://ml:5000")
-            response = requests.post(f"{ml_service_url}/analyze", files=files, data=form_data)
-            response.raise_for_status()  # Raise an exception for 4XX/5XX responses
-            
-            # Get analysis results
-            analysis_results = response.json()
+        # Hash the document so the same file is always routed to the same ML replica
+        content = await resume.read()
+        document_hash = hashlib.sha256(content).hexdigest()
         
-        # Clean up the temporary file
-        os.remove(file_location)
+        # Send to ML service (bytes, so the request can be replayed on failover)
+        files = {"resume": (resume.filename, content, resume.content_type)}
+        form_data = {"resume_id": resume_id, "token_counts": "1"}
         
-        # Store resume data in MongoDB
-        # Initialize MongoDB client
-        mongo_uri = os.environ.get("MONGO_URI", "mongodb://mongo:27017")
-        mongo_client = pymongo.MongoClient(mongo_uri)
-        db = mongo_client["resume_analyzer"]
+        def analyze():
+            response = ml_router.analyze(document_hash, files=files, data=form_data)
+            response.raise_for_status()  # Raise an exception for 4XX/5XX responses
+            return response.json()
         
-        # Store resume metadata
-        db.resumes.insert_one({
-            "id": resume_id,
-            "name": name,
-            "email": email,
-            "filename": resume.filename,
-            "upload_date": datetime.utcnow()
-        })
+        # Get analysis results, sharing the call with identical in-flight uploads
+        analysis_results = await ml_single_flight.do(document_hash, analyze)
         
-        # Store analysis results
-        db.analyses.insert_one({
-            "resume_id": resume_id,
-            "match_score": analysis_results.get("match_score", 0),
-            "skills_identified": analysis_results.get("skills_identified", []),
-            "missing_skills": analysis_results.get("missing_skills", []),
-            "recommendations": analysis_results.get("recommendations", []),
-            "analysis_date": datetime.utcnow()
-        })
+        store_analysis(write_buffer, resume_id, name, email, resume.filename, analysis_results)
         
         # Redirect to results page
         return RedirectResponse(url=f"/results/{resume_id}", status_code=303)
@@ -110,21 +154,121 @@ async def upload_resume(
     except requests.RequestException as e:
         # Handle ML service errors
         raise HTTPException(status_code=500, detail=f"ML service error: {str(e)}")
+    except BufferFullError as e:
+        # MongoDB has been unreachable for a while; ask the client to come back later
+        raise HTTPException(status_code=503, detail=f"Database unavailable: {str(e)}")
     except Exception as e:
         # Handle other errors
         raise HTTPException(status_code=500, detail=f"Error processing resume: {str(e)}")
 
+def ml_progress_events(ml_router, document_hash, files, resume_id):
+    """Yield the ML service's pipeline events for a document, always ending with done or error"""
+    try:
+        response = ml_router.analyze(
+            document_hash, files=files, data={"resume_id": resume_id, "progress": "1", "token_counts": "1"}, stream=True
+        )
+        try:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                yield event
+                if event.get("stage") in TERMINAL_STAGES:
+                    return
+            yield {"stage": "error", "error": "ML service ended the analysis early"}
+        finally:
+            # Hand the streamed connection back to the backend's pool
+            response.close()
+    except Exception as e:
+        yield {"stage": "error", "error": f"ML service error: {str(e)}"}
+
+def analyze_with_progress(ml_router, write_buffer, document_hash, files, resume_id, name, email):
+    """Publish the document's pipeline events to the progress hub and store the final result
+
+    Concurrent uploads of the same document share one streamed ML call.
+    """
+    def deliver(event):
+        try:
+            if event.get("stage") == "done":
+                store_analysis(write_buffer, resume_id, name, email, files["resume"][0], event["result"])
+                event = {"stage": "done", "results_url": f"/results/{resume_id}"}
+        except Exception as e:
+            event = {"stage": "error", "error": f"Error storing analysis: {str(e)}"}
+        progress_hub.publish(resume_id, event)
+
+    ml_stream_flight.do(
+        document_hash, lambda: ml_progress_events(ml_router, document_hash, files, resume_id), deliver
+    )
+
+@app.post("/api/upload", status_code=202)
+async def upload_resume_async(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    ml_router=Depends(get_ml_router),
+    write_buffer=Depends(get_write_buffer),
+    rate_limiter=Depends(get_rate_limiter),
+    name: str = Form(...),
+    email: str = Form(...),
+    resume: UploadFile = File(...)
+):
+    """Start an analysis in the background and return where to follow its progress"""
+    await check_rate_limit(request, rate_limiter, email)
+    
+    resume_id = str(uuid.uuid4())
+    content = await resume.read()
+    document_hash = hashlib.sha256(content).hexdigest()
+    files = {"resume": (resume.filename, content, resume.content_type)}
+    
+    progress_hub.start(resume_id)
+    background_tasks.add_task(
+        analyze_with_progress, ml_router, write_buffer, document_hash, files, resume_id, name, email
+    )
+    return JSONResponse(status_code=202, content={
+        "resume_id": resume_id,
+        "progress_url": f"/api/progress/{resume_id}",
+        "results_url": f"/results/{resume_id}"
+    })
+
+@app.get("/api/progress/{resume_id}")
+async def stream_progress(resume_id: str, db=Depends(get_database), write_buffer=Depends(get_write_buffer)):
+    """Server-Sent Events stream of an analysis' stages, ending with done or error"""
+    if progress_hub.has(resume_id):
+        events = progress_hub.subscribe(resume_id)
+    elif (write_buffer.find_one("analyses", {"resume_id": resume_id})
+          or db.analyses.find_one({"resume_id": resume_id})):
+        # Finished before the subscriber connected (or on another replica)
+        async def events():
+            yield {"stage": "done", "results_url": f"/results/{resume_id}"}
+        events = events()
+    else:
+        # Unknown here: either a bad id or still running on another api replica
+        raise HTTPException(status_code=404, detail="Analysis not found")
+    
+    return StreamingResponse(
+        sse_stream(events),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/results/{resume_id}", response_class=HTMLResponse)
-async def get_results(request: Request, resume_id: str, db=Depends(get_database)):
+async def get_results(
+    request: Request,
+    resume_id: str,
+    db=Depends(get_database),
+    write_buffer=Depends(get_write_buffer)
+):
     """Show analysis results"""
     try:
-        # Get analysis results
-        analysis = db.analyses.find_one({"resume_id": resume_id})
+        # Get analysis results, serving from the write buffer until it is flushed
+        analysis = (write_buffer.find_one("analyses", {"resume_id": resume_id})
+                    or db.analyses.find_one({"resume_id": resume_id}))
         if not analysis:
             raise HTTPException(status_code=404, detail="Analysis not found")
         
         # Get resume metadata
-        resume = db.resumes.find_one({"id": resume_id})
+        resume = (write_buffer.find_one("resumes", {"id": resume_id})
+                  or db.resumes.find_one({"id": resume_id}))
         if not resume:
             raise HTTPException(status_code=404, detail="Resume not found")
         
@@ -152,7 +296,7 @@ async def list_analyses(db=Depends(get_database)):
     """API endpoint to list recent analyses"""
     try:
         # Get recent analyses
-        analyses = list(db.analyses.find().sort("analysis_date", -1).limit(10))
+        analyses = list(db.analyses.find({}, {"token_counts": 0}).sort("analysis_date", -1).limit(10))
         
         # Convert ObjectId to string for JSON serialization
         for analysis in analyses:
@@ -0,0 +1,154 @@
+import bisect
+import hashlib
+import os
+import threading
+import time
+from functools import lru_cache
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# HTTP statuses that mean "this replica is unavailable", not "this document is bad"
+RETRYABLE_STATUSES = {502, 503, 504}
+
+
+def _ring_hash(key):
+    """Stable 64-bit hash so every api replica builds the same ring"""
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+def parse_backends(spec):
+    """Parse "url[|weight],url[|weight]" into a list of (url, weight) pairs"""
+    backends = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        url, _, weight = entry.partition("|")
+        backends.append((url.rstrip("/"), int(weight) if weight else 1))
+    return backends
+
+
+class MLBackend:
+    """One ml_matcher replica with its own connection pool and health state"""
+
+    def __init__(self, url, weight=1, pool_size=10):
+        self.url = url
+        self.weight = weight
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.down_until = 0.0
+        self._lock = threading.Lock()
+
+    def mark_down(self, cooldown):
+        """Take the backend out of rotation for `cooldown` seconds"""
+        with self._lock:
+            self.down_until = time.monotonic() + cooldown
+
+    def mark_up(self):
+        with self._lock:
+            self.down_until = 0.0
+
+    def check_health(self, timeout):
+        """Probe the backend's /health endpoint"""
+        try:
+            response = self.session.get(f"{self.url}/health", timeout=timeout)
+            return response.status_code == 200
+        except requests.RequestException:
+            return False
+
+    def is_available(self, cooldown, timeout):
+        """True if the backend is healthy, re-probing once its cooldown has expired"""
+        if self.down_until == 0.0:
+            return True
+        if time.monotonic() < self.down_until:
+            return False
+        if self.check_health(timeout):
+            self.mark_up()
+            return True
+        self.mark_down(cooldown)
+        return False
+
+    def post(self, path, **kwargs):
+        return self.session.post(f"{self.url}{path}", **kwargs)
+
+
+class MLRouter:
+    """Routes documents to ml_matcher replicas by consistent hashing on the document hash
+
+    Each backend owns `weight * replicas` virtual nodes on the ring, so the same
+    document always lands on the same replica (keeping its caches warm) and
+    heavier backends receive a proportionally larger share of documents. When a
+    backend fails, requests walk clockwise to the next healthy one.
+    """
+
+    def __init__(self, backends, replicas=100, cooldown=10.0, health_timeout=1.0, timeout=60.0):
+        if not backends:
+            raise ValueError("At least one ML backend is required")
+        self.backends = backends
+        self.cooldown = cooldown
+        self.health_timeout = health_timeout
+        self.timeout = timeout
+
+        ring = []
+        for backend in backends:
+            for i in range(backend.weight * replicas):
+                ring.append((_ring_hash(f"{backend.url}#{i}"), backend))
+        ring.sort(key=lambda node: node[0])
+        self._ring_keys = [key for key, _ in ring]
+        self._ring_nodes = [backend for _, backend in ring]
+
+    def candidates(self, document_hash):
+        """Backends in ring order starting from the owner of `document_hash`"""
+        start = bisect.bisect(self._ring_keys, _ring_hash(document_hash))
+        seen = set()
+        for i in range(len(self._ring_nodes)):
+            backend = self._ring_nodes[(start + i) % len(self._ring_nodes)]
+            if backend.url not in seen:
+                seen.add(backend.url)
+                yield backend
+                if len(seen) == len(self.backends):
+                    return
+
+    def analyze(self, document_hash, files, data, stream=False):
+        """POST a document to /analyze on its owning backend, failing over to the next healthy one
+
+        Only connection failures (including connect timeouts) and 502/503/504
+        fail over. A read timeout is raised to the caller: the replica accepted
+        the document, it is just slow on this one.
+        """
+        last_error = None
+        for backend in self.candidates(document_hash):
+            if not backend.is_available(self.cooldown, self.health_timeout):
+                continue
+            try:
+                response = backend.post("/analyze", files=files, data=data, timeout=self.timeout, stream=stream)
+            except requests.ConnectionError as e:
+                backend.mark_down(self.cooldown)
+                last_error = e
+                continue
+            if response.status_code in RETRYABLE_STATUSES:
+                # Release the (possibly streamed) connection before trying the next replica
+                response.close()
+                backend.mark_down(self.cooldown)
+                last_error = requests.HTTPError(
+                    f"{backend.url} returned {response.status_code}", response=response
+                )
+                continue
+            return response
+        raise last_error or requests.ConnectionError("No healthy ML backend available")
+
+
+@lru_cache(maxsize=None)
+def get_ml_router():
+    """Build the process-wide router from ML_API_URLS (falls back to ML_API_URL)"""
+    spec = os.environ.get("ML_API_URLS") or os.environ.get("ML_API_URL", "http://ml:5000")
+    pool_size = int(os.environ.get("ML_POOL_SIZE", 10))
+    backends = [MLBackend(url, weight, pool_size) for url, weight in parse_backends(spec)]
+    return MLRouter(
+        backends,
+        cooldown=float(os.environ.get("ML_HEALTH_COOLDOWN", 10)),
+        timeout=float(os.environ.get("ML_TIMEOUT", 60)),
+    )
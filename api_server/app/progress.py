@@ -0,0 +1,70 @@
+import asyncio
+import json
+import threading
+import time
+
+# Stages after which no more events are published for a resume
+TERMINAL_STAGES = {"done", "error"}
+
+
+class ProgressHub:
+    """In-process log of analysis progress events per resume_id
+
+    The analysis thread publishes events; any number of SSE subscribers replay
+    the log from the start and then follow it until a terminal stage. Finished
+    logs are kept for `ttl` seconds so a late subscriber still sees the outcome.
+
+    Logs are not shared between API replicas: a subscriber must reach the
+    replica that accepted the upload (sticky sessions), otherwise it only sees
+    the outcome once the analysis has been stored in Mongo.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._logs = {}      # resume_id -> [event, ...]
+        self._finished = {}  # resume_id -> time the terminal event was published
+        self._lock = threading.Lock()
+
+    def start(self, resume_id):
+        with self._lock:
+            self._prune()
+            self._logs[resume_id] = []
+
+    def publish(self, resume_id, event):
+        with self._lock:
+            self._logs.setdefault(resume_id, []).append(event)
+            if event.get("stage") in TERMINAL_STAGES:
+                self._finished[resume_id] = time.monotonic()
+
+    def has(self, resume_id):
+        with self._lock:
+            return resume_id in self._logs
+
+    def events_since(self, resume_id, index):
+        with self._lock:
+            return list(self._logs.get(resume_id, [])[index:])
+
+    async def subscribe(self, resume_id, poll_interval=0.1):
+        """Yield every event for `resume_id`, waiting for new ones until a terminal stage"""
+        index = 0
+        while True:
+            events = self.events_since(resume_id, index)
+            for event in events:
+                yield event
+                if event.get("stage") in TERMINAL_STAGES:
+                    return
+            index += len(events)
+            await asyncio.sleep(poll_interval)
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.ttl
+        for resume_id, finished_at in list(self._finished.items()):
+            if finished_at <= cutoff:
+                del self._finished[resume_id]
+                self._logs.pop(resume_id, None)
+
+
+async def sse_stream(events):
+    """Format an async iterator of event dicts as a text/event-stream body (stage is in the data)"""
+    async for event in events:
+        yield f"data: {json.dumps(event)}\n\n"
@@ -0,0 +1,201 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from pymongo import ReturnDocument
+from starlette.concurrency import run_in_threadpool
+
+
+def parse_limit(spec):
+    """Parse "<requests>/<seconds>" into a (capacity, refill tokens per second) bucket"""
+    count, _, seconds = spec.partition("/")
+    capacity = int(count)
+    return capacity, capacity / float(seconds or 1)
+
+
+class MemoryBucketStore:
+    """Token buckets held in this process
+
+    A bucket that has refilled is the same as a missing one, so full buckets
+    are dropped; past `max_keys` the least recently used bucket is evicted.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, last refill time, time it is full again), oldest first
+        self._lock = threading.Lock()
+
+    def consume(self, key, capacity, rate, now=None):
+        """Take one token from `key`'s bucket; return (allowed, seconds until a token is available)"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, updated, _ = self._buckets.pop(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+            self._prune(now)
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+    def refund(self, key, capacity, rate):
+        """Give back a token taken by `consume`"""
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated, _ = self._buckets[key]
+                tokens = min(capacity, tokens + 1)
+                self._buckets[key] = (tokens, updated, updated + (capacity - tokens) / rate)
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _prune(self, now):
+        while self._buckets:
+            _, _, full_at = next(iter(self._buckets.values()))
+            if full_at > now and len(self._buckets) <= self.max_keys:
+                break
+            self._buckets.popitem(last=False)
+
+
+class MongoBucketStore:
+    """Token buckets shared by every api replica through a Mongo collection
+
+    Refill and consume happen in one pipeline update, so concurrent replicas
+    cannot both spend the last token.
+    """
+
+    def __init__(self, collection, ttl_seconds=3600):
+        self.collection = collection
+        # Idle buckets are full again long before they expire
+        self.collection.create_index("updated", expireAfterSeconds=ttl_seconds)
+
+    def consume(self, key, capacity, rate, now=None):
+        now = now or datetime.utcnow()
+        elapsed = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated", now]}]}, 1000]}
+        refilled = {"$min": [capacity, {"$add": [{"$ifNull": ["$tokens", capacity]}, {"$multiply": [elapsed, rate]}]}]}
+        bucket = self.collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": refilled, "updated": now}},
+                {"$set": {
+                    "allowed": {"$gte": ["$tokens", 1]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                }},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if bucket["allowed"]:
+            return True, 0.0
+        return False, (1 - bucket["tokens"]) / rate
+
+    def refund(self, key, capacity, rate):
+        """Give back a token taken by `consume`"""
+        self.collection.update_one(
+            {"_id": key},
+            [{"$set": {"tokens": {"$min": [capacity, {"$add": ["$tokens", 1]}]}}}],
+        )
+
+
+class RateLimiter:
+    """Per-key token-bucket limits, e.g. {"email": (5, 5 / 60), "ip": (20, 20 / 60)}"""
+
+    def __init__(self, store, limits):
+        self.store = store
+        self.limits = limits
+
+    def check(self, **keys):
+        """Consume a token for every given key; return the Retry-After seconds of the first exhausted one, or None
+
+        A rejected request costs nothing: tokens already taken from the other
+        keys are refunded.
+        """
+        consumed = []
+        for kind, value in keys.items():
+            if kind not in self.limits or not value:
+                continue
+            key = f"{kind}:{value}"
+            allowed, retry_after = self.store.consume(key, *self.limits[kind])
+            if not allowed:
+                for spent_key, limit in consumed:
+                    self.store.refund(spent_key, *limit)
+                return retry_after
+            consumed.append((key, self.limits[kind]))
+        return None
+
+
+def limiter_from_env(get_db):
+    """Build a RateLimiter from RATE_LIMIT_EMAIL, RATE_LIMIT_IP and RATE_LIMIT_STORE (memory or mongo)"""
+    limits = {
+        "email": parse_limit(os.environ.get("RATE_LIMIT_EMAIL", "5/60")),
+        "ip": parse_limit(os.environ.get("RATE_LIMIT_IP", "20/60")),
+    }
+    if os.environ.get("RATE_LIMIT_STORE", "memory") == "mongo":
+        store = MongoBucketStore(get_db().rate_limits)
+    else:
+        store = MemoryBucketStore()
+    return RateLimiter(store, limits)
+
+
+class SingleFlight:
+    """Collapses concurrent calls that share a key into one call whose result they all receive"""
+
+    def __init__(self):
+        self._inflight = {}
+
+    async def do(self, key, fn, *args):
+        """Run blocking `fn(*args)` in the threadpool unless a call for `key` is already running"""
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(run_in_threadpool(fn, *args))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shield so one caller disconnecting does not cancel the call for everyone else
+        return await asyncio.shield(future)
+
+    def __len__(self):
+        return len(self._inflight)
+
+
+class StreamSingleFlight:
+    """Shares one event stream between concurrent callers with the same key
+
+    The first caller for a key runs the stream and hands each event to every
+    subscriber; callers that join mid-stream first get the events so far
+    replayed, so every subscriber sees the whole stream in order.
+    """
+
+    def __init__(self):
+        self._inflight = {}  # key -> {"lock", "events", "subscribers"}
+        self._lock = threading.Lock()
+
+    def do(self, key, stream, subscriber):
+        """Deliver every event of `stream()` to `subscriber`, running it only if no stream for `key` is in flight"""
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = {"lock": threading.Lock(), "events": [], "subscribers": [subscriber]}
+                self._inflight[key] = flight
+        if not leader:
+            with flight["lock"]:
+                for event in flight["events"]:
+                    subscriber(event)
+                flight["subscribers"].append(subscriber)
+            return
+
+        try:
+            for event in stream():
+                with flight["lock"]:
+                    flight["events"].append(event)
+                    for deliver in flight["subscribers"]:
+                        deliver(event)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def __len__(self):
+        return len(self._inflight)
@@ -0,0 +1,189 @@
+import os
+import threading
+import time
+from collections import deque
+
+from bson.errors import InvalidDocument
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, WriteConcernError, WriteError
+from pymongo.write_concern import WriteConcern
+
+# Mongo error code for a duplicate _id, seen when a partially applied batch is retried
+DUPLICATE_KEY = 11000
+
+# Failures worth retrying: the server was unreachable or could not confirm the
+# write concern in time. A BulkWriteError only gets this far when it carries
+# write concern errors; bad documents are dead-lettered inside _insert.
+TRANSIENT_ERRORS = (ConnectionFailure, WriteConcernError, BulkWriteError)
+
+
+class BufferFullError(Exception):
+    """Raised by `add` when Mongo has been failing long enough for the buffer to fill up"""
+
+
+def parse_write_concern(spec):
+    """Parse MONGO_WRITE_CONCERN ("1", "majority", "majority,j") into a WriteConcern, or None for the server default"""
+    if not spec:
+        return None
+    w, _, journal = spec.partition(",")
+    w = int(w) if w.isdigit() else w
+    return WriteConcern(w=w, j=True if journal == "j" else None)
+
+
+class WriteBehindBuffer:
+    """Groups inserts into per-collection insert_many batches
+
+    Documents are flushed by a background thread when `max_batch` are pending
+    or every `max_delay` seconds, whichever comes first; `add` never talks to
+    Mongo itself, so it is safe to call from the event loop. Until a document is
+    written it can still be read back with `find_one`, so a redirect straight
+    after an insert sees it.
+
+    Batches that fail for transient reasons (connection loss, write concern
+    timeouts) are requeued; documents Mongo will never accept (too large,
+    unencodable, rejected by a validator) are logged and kept in
+    `dead_letters` instead, so they cannot block the documents behind them.
+    """
+
+    def __init__(self, db, max_batch=50, max_delay=0.05, write_concern=None, max_pending=10000,
+                 max_dead_letters=100):
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.write_concern = write_concern
+        self.max_pending = max_pending
+        self.dead_letters = deque(maxlen=max_dead_letters)  # (collection, _id, reason)
+        self._pending = []   # (collection, doc) waiting for the next flush
+        self._inflight = []  # (collection, doc) being written right now
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()  # set when a full batch is waiting
+        self._thread = None
+        self._closed = False
+
+    def add(self, collection, doc):
+        """Queue `doc` for insertion into `collection`, raising BufferFullError if `max_pending` are queued"""
+        self.add_many([(collection, doc)])
+
+    def add_many(self, entries):
+        """Queue (collection, doc) pairs all together, or none of them if the buffer has no room"""
+        # Assign the _id up front so buffered reads look like stored documents
+        # and a retried batch cannot insert the same document twice
+        for _, doc in entries:
+            doc.setdefault("_id", ObjectId())
+        with self._lock:
+            if len(self._pending) + len(entries) > self.max_pending:
+                raise BufferFullError(f"{len(self._pending)} documents are waiting for MongoDB")
+            self._pending.extend(entries)
+            if len(self._pending) >= self.max_batch:
+                self._wake.set()
+        self._ensure_thread()
+
+    def find_one(self, collection, query):
+        """Return a copy of the newest unflushed document matching an equality `query`, or None"""
+        with self._lock:
+            for name, doc in reversed(self._inflight + self._pending):
+                if name == collection and all(doc.get(k) == v for k, v in query.items()):
+                    return dict(doc)
+        return None
+
+    def flush(self):
+        """Write every pending document, requeueing collections that hit a transient Mongo failure"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._inflight = batch
+            if not batch:
+                return
+            retry, error = [], None
+            try:
+                by_collection = {}
+                for name, doc in batch:
+                    by_collection.setdefault(name, []).append(doc)
+                for name, docs in by_collection.items():
+                    try:
+                        self._insert(name, docs)
+                    except TRANSIENT_ERRORS as e:
+                        retry.extend((name, doc) for doc in docs)
+                        error = e
+                    except Exception as e:
+                        for doc in docs:
+                            self._dead_letter(name, doc, e)
+                if retry:
+                    with self._lock:
+                        self._pending = retry + self._pending
+            finally:
+                with self._lock:
+                    self._inflight = []
+            if error is not None:
+                raise error
+
+    def close(self):
+        """Stop the background flusher and write whatever is left"""
+        self._closed = True
+        self._wake.set()
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Write-behind buffer closed with {len(self._pending)} documents unwritten:", e)
+
+    def _insert(self, name, docs):
+        collection = getattr(self.db, name)
+        if self.write_concern is not None:
+            collection = collection.with_options(write_concern=self.write_concern)
+        try:
+            collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            if e.details.get("writeConcernErrors"):
+                raise
+            # Documents already written by an earlier partial flush are fine
+            for err in e.details.get("writeErrors", []):
+                if err.get("code") != DUPLICATE_KEY:
+                    self._dead_letter(name, docs[err["index"]], err.get("errmsg"))
+        except InvalidDocument:
+            # One oversized or unencodable document fails the whole insert_many
+            # before anything is sent, so write the batch one document at a time
+            for doc in docs:
+                try:
+                    collection.insert_one(doc)
+                except DuplicateKeyError:
+                    pass
+                except (InvalidDocument, WriteError) as e:
+                    self._dead_letter(name, doc, e)
+
+    def _dead_letter(self, name, doc, reason):
+        self.dead_letters.append((name, doc.get("_id"), str(reason)))
+        print(f"Dropping {name} document {doc.get('_id')} that MongoDB rejected:", reason)
+
+    def _ensure_thread(self):
+        if self._thread is None and not self._closed:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.max_delay)
+            self._wake.clear()
+            if self._pending and not self._closed and not self._flush_and_log():
+                # A failed batch stays full, so back off instead of retrying on every add
+                time.sleep(self.max_delay)
+
+    def _flush_and_log(self):
+        # Failed batches stay queued (and readable) for the background flusher to retry
+        try:
+            self.flush()
+            return True
+        except Exception as e:
+            print("Write-behind flush failed, will retry:", e)
+            return False
+
+
+def buffer_from_env(db):
+    """Build a WriteBehindBuffer configured by the MONGO_BATCH_*, MONGO_WRITE_CONCERN and MONGO_BUFFER_MAX variables"""
+    return WriteBehindBuffer(
+        db,
+        max_batch=int(os.environ.get("MONGO_BATCH_SIZE", 50)),
+        max_delay=int(os.environ.get("MONGO_BATCH_WINDOW_MS", 50)) / 1000,
+        write_concern=parse_write_concern(os.environ.get("MONGO_WRITE_CONCERN")),
+        max_pending=int(os.environ.get("MONGO_BUFFER_MAX", 10000)),
+    )
@@ -10,7 +10,18 @@ from datetime import datetime
 # Add the parent directory to the path so we can import the app
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from app.main import app, get_database
+from app.main import app, get_database, get_write_buffer, get_rate_limiter, ml_stream_flight, progress_hub
+from app.progress import ProgressHub
+from app.ml_router import MLBackend, MLRouter, get_ml_router, parse_backends
+from app.write_buffer import BufferFullError, WriteBehindBuffer, parse_write_concern
+from pymongo.errors import AutoReconnect, BulkWriteError, DocumentTooLarge
+from app.rate_limit import (
+    MemoryBucketStore, MongoBucketStore, RateLimiter, SingleFlight, parse_limit
+)
+import asyncio
+import threading
+import time
+import requests
 
 client = TestClient(app)
 
@@ -61,9 +72,20 @@ def mock_mongo(monkeypatch):
 
     app.dependency_overrides[get_database] = lambda: mock_db
 
+    # Long window so tests decide when the write buffer flushes
+    write_buffer = WriteBehindBuffer(mock_db, max_batch=100, max_delay=60)
+    app.dependency_overrides[get_write_buffer] = lambda: write_buffer
+
+    rate_limiter = RateLimiter(MemoryBucketStore(), {"email": parse_limit("5/60"), "ip": parse_limit("20/60")})
+    app.dependency_overrides[get_rate_limiter] = lambda: rate_limiter
+
+    # Fresh router so replicas marked down by an earlier test are back in rotation
+    get_ml_router.cache_clear()
+
     return {
         "client": mock_client,
         "db": mock_db,
+        "write_buffer": write_buffer,
         "resume_collection": mock_resume_collection,
         "analysis_collection": mock_analysis_collection
     }
@@ -74,7 +96,7 @@ def test_read_root(mock_mongo):
     assert response.status_code == 200
     assert "text/html" in response.headers["content-type"]
 
-@patch("app.main.requests.post")
+@patch("app.ml_router.requests.Session.post")
 def test_upload_resume_success(mock_post, mock_mongo):
     """Test successful resume upload and analysis"""
     mock_response = MagicMock()
@@ -97,12 +119,17 @@ def test_upload_resume_success(mock_post, mock_mongo):
     assert response.status_code == 200
     assert "text/html" in response.headers["content-type"]
 
+    # The redirect is served from the write buffer before anything hits Mongo
     resume_collection = mock_mongo["resume_collection"]
     analysis_collection = mock_mongo["analysis_collection"]
-    assert resume_collection.insert_one.call_count == 1
-    assert analysis_collection.insert_one.call_count == 1
+    assert resume_collection.insert_many.call_count == 0
+    analysis_collection.find_one.assert_not_called()
 
-@patch("app.main.requests.post")
+    mock_mongo["write_buffer"].flush()
+    assert resume_collection.insert_many.call_count == 1
+    assert analysis_collection.insert_many.call_count == 1
+
+@patch("app.ml_router.requests.Session.post")
 def test_upload_resume_ml_error(mock_post, mock_mongo):
     """Test error handling when ML service fails"""
     mock_post.side_effect = Exception("ML service error")
@@ -148,3 +175,387 @@ def test_list_analyses(mock_mongo):
 
     analysis_collection = mock_mongo["analysis_collection"]
     analysis_collection.find.assert_called_once()
+
+def test_parse_backends():
+    assert parse_backends("http://ml1:5000|3, http://ml2:5000/") == [
+        ("http://ml1:5000", 3),
+        ("http://ml2:5000", 1),
+    ]
+
+def test_router_is_consistent_and_weighted():
+    heavy = MLBackend("http://ml1:5000", weight=3)
+    light = MLBackend("http://ml2:5000", weight=1)
+    router = MLRouter([heavy, light])
+
+    owners = [next(router.candidates(f"doc-{i}")).url for i in range(2000)]
+    assert owners == [next(router.candidates(f"doc-{i}")).url for i in range(2000)]
+    assert owners.count("http://ml1:5000") > 2 * owners.count("http://ml2:5000")
+
+def test_router_fails_over_to_next_backend():
+    router = MLRouter([MLBackend("http://ml1:5000"), MLBackend("http://ml2:5000")])
+    owner, fallback = list(router.candidates("doc-hash"))
+    ok = MagicMock(status_code=200)
+
+    def fake_post(path, **kwargs):
+        raise requests.ConnectionError("down")
+
+    with patch.object(owner, "post", side_effect=fake_post), \
+         patch.object(fallback, "post", return_value=ok) as fallback_post:
+        assert router.analyze("doc-hash", files={}, data={}) is ok
+        fallback_post.assert_called_once()
+    assert owner.down_until > 0
+
+    # While cooling down the owner is skipped without being contacted
+    with patch.object(owner, "post") as owner_post, \
+         patch.object(fallback, "post", return_value=ok):
+        router.analyze("doc-hash", files={}, data={})
+        owner_post.assert_not_called()
+
+def test_router_raises_when_all_backends_down():
+    router = MLRouter([MLBackend("http://ml1:5000")])
+    backend = router.backends[0]
+    unavailable = MagicMock(status_code=503)
+    with patch.object(backend, "post", return_value=unavailable):
+        with pytest.raises(requests.HTTPError):
+            router.analyze("doc-hash", files={}, data={}, stream=True)
+    unavailable.close.assert_called_once()
+
+def test_router_raises_read_timeout_without_failover():
+    router = MLRouter([MLBackend("http://ml1:5000"), MLBackend("http://ml2:5000")])
+    owner, fallback = list(router.candidates("doc-hash"))
+    with patch.object(owner, "post", side_effect=requests.ReadTimeout("slow document")), \
+         patch.object(fallback, "post") as fallback_post:
+        with pytest.raises(requests.ReadTimeout):
+            router.analyze("doc-hash", files={}, data={})
+        fallback_post.assert_not_called()
+    assert owner.down_until == 0.0
+
+    # A connect timeout means the replica is unreachable, so it fails over
+    ok = MagicMock(status_code=200)
+    with patch.object(owner, "post", side_effect=requests.ConnectTimeout("unreachable")), \
+         patch.object(fallback, "post", return_value=ok):
+        assert router.analyze("doc-hash", files={}, data={}) is ok
+    assert owner.down_until > 0
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def test_write_buffer_batches_by_size():
+    db = MagicMock()
+    buffer = WriteBehindBuffer(db, max_batch=3, max_delay=60)
+    buffer.add("resumes", {"id": "a"})
+    buffer.add("analyses", {"resume_id": "a"})
+    assert db.resumes.insert_many.call_count == 0
+
+    buffer.add("resumes", {"id": "b"})
+    # The full batch is written by the background flusher, not by add()
+    assert _wait_for(lambda: db.analyses.insert_many.called)
+    (docs,), kwargs = db.resumes.insert_many.call_args
+    assert [d["id"] for d in docs] == ["a", "b"]
+    assert all("_id" in d for d in docs)
+    assert db.analyses.insert_many.call_count == 1
+    assert buffer.find_one("resumes", {"id": "a"}) is None
+
+def test_write_buffer_requeues_failed_batch():
+    db = MagicMock()
+    db.resumes.insert_many.side_effect = AutoReconnect("mongo down")
+    buffer = WriteBehindBuffer(db, max_batch=100, max_delay=60)
+    buffer.add("resumes", {"id": "a"})
+    buffer.add("analyses", {"resume_id": "a"})
+    with pytest.raises(AutoReconnect):
+        buffer.flush()
+    assert buffer.find_one("resumes", {"id": "a"})["id"] == "a"
+    # Only the collection that failed is retried
+    assert buffer.find_one("analyses", {"resume_id": "a"}) is None
+
+    db.resumes.insert_many.side_effect = None
+    buffer.close()
+    assert buffer.find_one("resumes", {"id": "a"}) is None
+
+def test_write_buffer_drops_documents_mongo_rejects():
+    def insert_one(doc):
+        if doc["resume_id"] == "big":
+            raise DocumentTooLarge("document too large")
+
+    db = MagicMock()
+    db.analyses.insert_many.side_effect = DocumentTooLarge("document too large")
+    db.analyses.insert_one.side_effect = insert_one
+    buffer = WriteBehindBuffer(db, max_batch=100, max_delay=60)
+    buffer.add("analyses", {"resume_id": "big"})
+    buffer.add("analyses", {"resume_id": "ok"})
+    buffer.flush()
+    assert db.analyses.insert_one.call_count == 2
+    assert [(name, reason) for name, _, reason in buffer.dead_letters] == [("analyses", "document too large")]
+    assert buffer.find_one("analyses", {"resume_id": "ok"}) is None
+
+    db.resumes.insert_many.side_effect = BulkWriteError({"writeErrors": [
+        {"index": 0, "code": 11000, "errmsg": "duplicate"},
+        {"index": 1, "code": 121, "errmsg": "failed validation"},
+    ]})
+    buffer.add("resumes", {"id": "dup"})
+    buffer.add("resumes", {"id": "invalid"})
+    buffer.close()
+    assert buffer.dead_letters[-1][2] == "failed validation"
+    assert buffer.find_one("resumes", {"id": "invalid"}) is None
+
+def test_write_buffer_is_bounded():
+    db = MagicMock()
+    db.resumes.insert_many.side_effect = AutoReconnect("mongo down")
+    buffer = WriteBehindBuffer(db, max_batch=100, max_delay=60, max_pending=2)
+    buffer.add("resumes", {"id": "a"})
+    buffer.add("resumes", {"id": "b"})
+    with pytest.raises(BufferFullError):
+        buffer.add("resumes", {"id": "c"})
+    # Related documents are queued all together or not at all
+    with pytest.raises(BufferFullError):
+        buffer.add_many([("resumes", {"id": "d"}), ("analyses", {"resume_id": "d"})])
+    assert buffer.find_one("resumes", {"id": "d"}) is None
+    # Shutdown logs what could not be written instead of raising
+    buffer.close()
+    assert buffer.find_one("resumes", {"id": "a"})["id"] == "a"
+
+def test_write_buffer_add_never_writes_inline():
+    db = MagicMock()
+    callers = []
+
+    def failing_insert(docs, **kwargs):
+        callers.append(threading.current_thread())
+        raise AutoReconnect("mongo down")
+
+    db.resumes.insert_many.side_effect = failing_insert
+    buffer = WriteBehindBuffer(db, max_batch=2, max_delay=60)
+    buffer.add("resumes", {"id": "a"})
+    buffer.add("resumes", {"id": "b"})
+    assert _wait_for(lambda: callers)
+    # The batch is still full after the failure; adding more must not retry Mongo
+    for i in range(6):
+        buffer.add("resumes", {"id": f"c{i}"})
+    assert threading.current_thread() not in callers
+    assert len(callers) == 1
+    assert buffer.find_one("resumes", {"id": "a"})["id"] == "a"
+
+def test_write_buffer_applies_write_concern():
+    db = MagicMock()
+    concern = parse_write_concern("majority,j")
+    assert concern.document == {"w": "majority", "j": True}
+    buffer = WriteBehindBuffer(db, write_concern=concern)
+    buffer.add("resumes", {"id": "a"})
+    buffer.flush()
+    db.resumes.with_options.assert_called_once_with(write_concern=concern)
+    db.resumes.with_options.return_value.insert_many.assert_called_once()
+
+def test_memory_bucket_refills():
+    store = MemoryBucketStore()
+    capacity, rate = parse_limit("2/10")
+    assert store.consume("k", capacity, rate, now=0)[0]
+    assert store.consume("k", capacity, rate, now=0)[0]
+    allowed, retry_after = store.consume("k", capacity, rate, now=0)
+    assert not allowed and retry_after == pytest.approx(5)
+    assert store.consume("k", capacity, rate, now=5)[0]
+
+def test_memory_bucket_store_is_bounded():
+    store = MemoryBucketStore(max_keys=3)
+    capacity, rate = parse_limit("2/10")
+    for i in range(5):
+        store.consume(f"k{i}", capacity, rate, now=0)
+    assert len(store) == 3
+    # Buckets that have refilled by now are dropped
+    store.consume("new", capacity, rate, now=5)
+    assert len(store) == 1
+
+def test_rate_limiter_refunds_when_a_later_key_is_exhausted():
+    store = MemoryBucketStore()
+    limiter = RateLimiter(store, {"email": parse_limit("1/60"), "ip": parse_limit("1/60")})
+    assert limiter.check(email="a@b.c", ip="1.2.3.4") is None
+    # The IP is exhausted, so this email must not lose its token
+    assert limiter.check(email="x@y.z", ip="1.2.3.4") is not None
+    assert limiter.check(email="x@y.z", ip="5.6.7.8") is None
+
+def test_mongo_bucket_store_uses_atomic_upsert():
+    collection = MagicMock()
+    collection.find_one_and_update.return_value = {"allowed": False, "tokens": 0.5}
+    store = MongoBucketStore(collection)
+    collection.create_index.assert_called_once()
+
+    allowed, retry_after = store.consume("email:a@b.c", 5, 0.1)
+    assert not allowed and retry_after == pytest.approx(5)
+    args, kwargs = collection.find_one_and_update.call_args
+    assert args[0] == {"_id": "email:a@b.c"}
+    assert kwargs["upsert"] is True
+
+    store.refund("email:a@b.c", 5, 0.1)
+    args, _ = collection.update_one.call_args
+    assert args[0] == {"_id": "email:a@b.c"}
+
+@patch("app.ml_router.requests.Session.post")
+def test_upload_rate_limited_per_email(mock_post, mock_mongo):
+    mock_post.return_value = MagicMock(status_code=200, json=lambda: {"match_score": 1})
+    rate_limiter = RateLimiter(MemoryBucketStore(), {"email": parse_limit("1/60")})
+    app.dependency_overrides[get_rate_limiter] = lambda: rate_limiter
+
+    def upload(email):
+        return client.post(
+            "/upload",
+            files={"resume": ("r.txt", b"Python", "text/plain")},
+            data={"name": "Test User", "email": email}
+        )
+
+    assert upload("Test@Example.com").status_code == 200
+    response = upload("test@example.com ")
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) > 0
+    assert upload("other@example.com").status_code == 200
+    assert mock_post.call_count == 2
+
+def test_rate_limit_check_runs_off_the_event_loop(mock_mongo):
+    on_loop = []
+
+    class RecordingLimiter:
+        def check(self, **keys):
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(True)
+            except RuntimeError:
+                on_loop.append(False)
+            return 30
+
+    app.dependency_overrides[get_rate_limiter] = lambda: RecordingLimiter()
+    response = client.post(
+        "/api/upload",
+        files={"resume": ("r.txt", b"Python", "text/plain")},
+        data={"name": "Test User", "email": "test@example.com"}
+    )
+    assert response.status_code == 429
+    assert on_loop == [False]
+
+def test_single_flight_collapses_concurrent_calls():
+    calls = []
+    release = threading.Event()
+
+    def slow_call():
+        calls.append(1)
+        release.wait(5)
+        return {"ok": True}
+
+    async def run():
+        flight = SingleFlight()
+        tasks = [asyncio.ensure_future(flight.do("doc", slow_call)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        assert len(flight) == 1
+        release.set()
+        results = await asyncio.gather(*tasks)
+        assert len(flight) == 0
+        return results
+
+    assert asyncio.run(run()) == [{"ok": True}] * 3
+    assert len(calls) == 1
+
+def _sse_events(body):
+    return [json.loads(block.split("data: ", 1)[1]) for block in body.strip().split("\n\n")]
+
+@patch("app.ml_router.requests.Session.post")
+def test_upload_async_streams_progress(mock_post, mock_mongo):
+    ml_events = [
+        {"stage": "extracting"},
+        {"stage": "extracting", "page": 1, "pages": 1},
+        {"stage": "skills", "skills_identified": ["Python"]},
+        {"stage": "done", "result": {"match_score": 95, "skills_identified": ["Python"]}},
+    ]
+    mock_response = MagicMock(status_code=200)
+    mock_response.iter_lines.return_value = [json.dumps(e).encode() for e in ml_events]
+    mock_post.return_value = mock_response
+
+    response = client.post(
+        "/api/upload",
+        files={"resume": ("r.pdf", b"%PDF", "application/pdf")},
+        data={"name": "Test User", "email": "test@example.com"}
+    )
+    assert response.status_code == 202
+    body = response.json()
+    assert mock_post.call_args.kwargs["stream"] is True
+    assert mock_post.call_args.kwargs["data"]["progress"] == "1"
+    mock_response.close.assert_called_once()
+
+    progress = client.get(body["progress_url"])
+    assert progress.headers["content-type"].startswith("text/event-stream")
+    events = _sse_events(progress.text)
+    assert [e["stage"] for e in events] == ["extracting", "extracting", "skills", "done"]
+    assert events[-1]["results_url"] == body["results_url"]
+
+    analysis = mock_mongo["write_buffer"].find_one("analyses", {"resume_id": body["resume_id"]})
+    assert analysis["match_score"] == 95
+
+@patch("app.ml_router.requests.Session.post")
+def test_upload_async_reports_ml_error(mock_post, mock_mongo):
+    mock_post.side_effect = requests.ConnectionError("refused")
+    response = client.post(
+        "/api/upload",
+        files={"resume": ("r.pdf", b"%PDF", "application/pdf")},
+        data={"name": "Test User", "email": "test@example.com"}
+    )
+    events = _sse_events(client.get(response.json()["progress_url"]).text)
+    assert events[-1]["stage"] == "error"
+    assert "refused" in events[-1]["error"]
+
+@patch("app.ml_router.requests.Session.post")
+def test_upload_async_shares_ml_stream_for_same_document(mock_post, mock_mongo):
+    ml_events = [
+        {"stage": "extracting"},
+        {"stage": "done", "result": {"match_score": 80}},
+    ]
+    mock_response = MagicMock(status_code=200)
+    mock_response.iter_lines.return_value = [json.dumps(e).encode() for e in ml_events]
+    posted, release = threading.Event(), threading.Event()
+
+    def slow_post(*args, **kwargs):
+        posted.set()
+        release.wait(5)
+        return mock_response
+
+    mock_post.side_effect = slow_post
+
+    def upload():
+        return client.post(
+            "/api/upload",
+            files={"resume": ("r.pdf", b"%PDF same bytes", "application/pdf")},
+            data={"name": "Test User", "email": "test@example.com"}
+        )
+
+    first = {}
+    leader = threading.Thread(target=lambda: first.update(response=upload()))
+    leader.start()
+    assert posted.wait(5)
+    second = upload()
+    assert len(ml_stream_flight) == 1
+    release.set()
+    leader.join(5)
+
+    assert mock_post.call_count == 1
+    for response in (first["response"], second):
+        body = response.json()
+        events = _sse_events(client.get(body["progress_url"]).text)
+        assert [e["stage"] for e in events] == ["extracting", "done"]
+        analysis = mock_mongo["write_buffer"].find_one("analyses", {"resume_id": body["resume_id"]})
+        assert analysis["match_score"] == 80
+    assert len(ml_stream_flight) == 0
+
+def test_progress_for_finished_analysis(mock_mongo):
+    events = _sse_events(client.get("/api/progress/test-id").text)
+    assert events == [{"stage": "done", "results_url": "/results/test-id"}]
+
+def test_progress_not_found(mock_mongo):
+    mock_mongo["analysis_collection"].find_one.return_value = None
+    assert client.get("/api/progress/unknown").status_code == 404
+
+def test_progress_hub_prunes_finished_logs():
+    hub = ProgressHub(ttl=0)
+    hub.start("a")
+    hub.publish("a", {"stage": "done"})
+    hub.start("b")
+    assert not hub.has("a")
+    assert hub.has("b")
@@ -0,0 +1,136 @@
+# ml_matcher/app/extractors.py
+import codecs
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+
+# WordprocessingML namespaces used by the streaming DOCX reader
+_W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_MC_FALLBACK = '{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback'
+
+# Parts of a DOCX archive that carry visible text, read in page order
+_HEADER_PART = re.compile(r'^word/header\d*\.xml$')
+_FOOTER_PART = re.compile(r'^word/footer\d*\.xml$')
+_DOCUMENT_PART = 'word/document.xml'
+
+# Byte-order marks, longest first so UTF-32 LE is not mistaken for UTF-16 LE
+_BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+# Single-byte fallback for legacy (Latin-1 / Windows) text files
+_LEGACY_ENCODING = 'cp1252'
+_TXT_SNIFF_BYTES = 4096
+_TXT_CHUNK_BYTES = 64 * 1024
+TXT_MAX_BYTES = 5 * 1024 * 1024
+
+
+class FileTooLargeError(ValueError):
+    """Raised when an upload exceeds the byte cap for its format"""
+
+
+def _docx_text_parts(names):
+    """Return the text-bearing XML parts of a DOCX archive: headers, body, footers"""
+    headers = sorted(name for name in names if _HEADER_PART.match(name))
+    footers = sorted(name for name in names if _FOOTER_PART.match(name))
+    body = [_DOCUMENT_PART] if _DOCUMENT_PART in names else []
+    return headers + body + footers
+
+
+def _iter_part_paragraphs(xml_stream):
+    """Incrementally parse one WordprocessingML part and yield the text of each paragraph"""
+    # Paragraphs nest inside text boxes, so keep a stack of run buffers
+    paragraphs = []
+    # Open elements; each one is detached from its parent as soon as it ends,
+    # so memory stays bounded by the nesting depth, not the document size
+    open_elements = []
+    # Text boxes are stored twice (DrawingML + VML fallback); only read the first copy
+    fallback_depth = 0
+
+    for event, elem in ET.iterparse(xml_stream, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            open_elements.append(elem)
+            if tag == _MC_FALLBACK:
+                fallback_depth += 1
+            elif tag == _W + 'p' and not fallback_depth:
+                paragraphs.append([])
+            continue
+
+        open_elements.pop()
+        if open_elements:
+            open_elements[-1].remove(elem)
+
+        if tag == _MC_FALLBACK:
+            fallback_depth -= 1
+        elif fallback_depth or not paragraphs:
+            continue
+        elif tag == _W + 't':
+            paragraphs[-1].append(elem.text or '')
+        elif tag == _W + 'tab':
+            paragraphs[-1].append('\t')
+        elif tag in (_W + 'br', _W + 'cr'):
+            paragraphs[-1].append('\n')
+        elif tag == _W + 'p':
+            text = ''.join(paragraphs.pop())
+            if text:
+                yield text + '\n'
+
+
+def iter_docx_text(docx_file):
+    """Stream text from a DOCX file paragraph by paragraph, including tables, text boxes, headers and footers"""
+    with zipfile.ZipFile(docx_file) as archive:
+        for part in _docx_text_parts(archive.namelist()):
+            with archive.open(part) as xml_stream:
+                yield from _iter_part_paragraphs(xml_stream)
+
+
+def sniff_text_encoding(sample):
+    """Guess the encoding of a text file from its first bytes (BOM first, then heuristics)"""
+    for bom, encoding in _BOMS:
+        if sample.startswith(bom):
+            return encoding
+
+    # UTF-16 without a BOM: ASCII text leaves every other byte NUL
+    if sample.count(b'\x00') > len(sample) // 4:
+        even_nuls = sample[0::2].count(b'\x00')
+        odd_nuls = sample[1::2].count(b'\x00')
+        return 'utf-16-le' if odd_nuls > even_nuls else 'utf-16-be'
+
+    # A truncated multi-byte sequence at the end of the sample is fine
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return _LEGACY_ENCODING
+
+
+def iter_txt_text(txt_file, max_bytes=TXT_MAX_BYTES, chunk_size=_TXT_CHUNK_BYTES):
+    """Decode a text file incrementally and yield text chunks that end on a word boundary"""
+    sample = txt_file.read(_TXT_SNIFF_BYTES)
+    decoder = codecs.getincrementaldecoder(sniff_text_encoding(sample))(errors='replace')
+
+    total = 0
+    carry = ''
+    data = sample
+    while data:
+        total += len(data)
+        if total > max_bytes:
+            raise FileTooLargeError(f"Text file exceeds the {max_bytes} byte limit")
+
+        text = carry + decoder.decode(data)
+        # Hold back a trailing partial word so it is not split across chunks
+        cut = max(text.rfind(' '), text.rfind('\n'), text.rfind('\t'))
+        if cut == -1:
+            carry = text
+        else:
+            carry = text[cut + 1:]
+            yield text[:cut + 1]
+        data = txt_file.read(chunk_size)
+
+    tail = carry + decoder.decode(b'', final=True)
+    if tail:
+        yield tail
@@ -1,26 +1,26 @@
 # ml_matcher/app/main.py
-from flask import Flask, request, jsonify
+# Heavy dependencies (PyPDF2, NLTK, scikit-learn via the pickles) are imported on
+# first use so a new replica is ready to serve as soon as Flask is up.
+from app.startup import STARTUP_TIMINGS, mark_ready, timed
+
+with timed('import flask'):
+    from flask import Flask, Response, request, jsonify, stream_with_context
 import os
-import numpy as np
-import PyPDF2
-import docx
-import nltk
+import json
 import re
 import pickle
+import threading
 
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
+from app import extractors, profiling
+from app.extractors import FileTooLargeError, iter_docx_text, iter_txt_text
+from app.profiling import MemoryLimitExceeded
+from app.training import token_counts
 
 # Initialize Flask app
 app = Flask(__name__)
 
-# Make sure NLTK data is downloaded (this is needed for tokenization and stopwords)
-try:
-    nltk.data.find('tokenizers/punkt')
-    nltk.data.find('corpora/stopwords')
-except LookupError:
-    nltk.download('punkt')
-    nltk.download('stopwords')
+# Opt-in tracemalloc profiling / memory ceiling (ML_PROFILE, ML_MEMORY_LIMIT_MB)
+profiling.start_tracing()
 
 # Skill database - in a real application, this would come from MongoDB
 # This is a simplified version for development
@@ -38,48 +38,106 @@ SKILL_DEMAND = {
     "AWS": 90, "Docker": 90, "MongoDB": 80, "PostgreSQL": 85, "Machine Learning": 90
 }
 
+# Upper bound on bytes read from a TXT upload
+TXT_MAX_BYTES = int(os.environ.get('TXT_MAX_BYTES', extractors.TXT_MAX_BYTES))
+
 base_dir = os.path.dirname(os.path.abspath(__file__))
 
-with open(os.path.join(base_dir, 'model', 'model.pkl'), 'rb') as f:
-    model = pickle.load(f)
-with open(os.path.join(base_dir, 'model', 'vectorizer.pkl'), 'rb') as f:
-    vectorizer = pickle.load(f)
-with open(os.path.join(base_dir, 'model', 'label_encoder.pkl'), 'rb') as f:
-    label_encoder = pickle.load(f)
-with open(os.path.join(base_dir, 'model', 'grouped_tokens.pkl'), 'rb') as f:
-    grouped_tokens = pickle.load(f)
-
-def extract_text_from_pdf(pdf_file):
-    """Extract text from a PDF file"""
-    pdf_reader = PyPDF2.PdfReader(pdf_file)
-    text = ""
-    for page in pdf_reader.pages:
-        text += page.extract_text()
-    return text
+# Model bundle to serve; point at app/model/bundles/<version> to use a retrained model
+MODEL_DIR = os.environ.get('MODEL_DIR', os.path.join(base_dir, 'model'))
+
+# Pickled model artifacts, loaded on first use
+MODEL_FILES = {
+    'model': 'model.pkl',
+    'vectorizer': 'vectorizer.pkl',
+    'label_encoder': 'label_encoder.pkl',
+    'grouped_tokens': 'grouped_tokens.pkl',
+}
+_models = {}
+_models_lock = threading.Lock()
+_stop_words = None
+_pypdf2 = None
+# Set once warm_up has loaded everything; /health reports 503 until then
+_warmed_up = threading.Event()
+
+def get_model(name):
+    """Load a pickled model artifact the first time it is needed"""
+    with _models_lock:
+        if name not in _models:
+            with timed(f'load {MODEL_FILES[name]}'):
+                with open(os.path.join(MODEL_DIR, MODEL_FILES[name]), 'rb') as f:
+                    _models[name] = pickle.load(f)
+        return _models[name]
+
+def get_stop_words():
+    """Load the English stopword list from the NLTK data baked into the image"""
+    global _stop_words
+    if _stop_words is None:
+        with timed('load nltk stopwords'):
+            from nltk.corpus import stopwords
+            _stop_words = frozenset(stopwords.words('english'))
+    return _stop_words
+
+def get_pypdf2():
+    """Import PyPDF2 the first time a PDF is analysed"""
+    global _pypdf2
+    if _pypdf2 is None:
+        with timed('import PyPDF2'):
+            import PyPDF2
+            _pypdf2 = PyPDF2
+    return _pypdf2
+
+def warm_up():
+    """Load the classifier, NLTK data and PyPDF2 in the background after startup"""
+    for name in ('model', 'vectorizer', 'label_encoder'):
+        get_model(name)
+    get_stop_words()
+    get_pypdf2()
+    with timed('import nltk tokenizer'):
+        from nltk.tokenize import word_tokenize  # noqa: F401
+    _warmed_up.set()
+
+def extract_text_from_pdf(pdf_file, on_page=None):
+    """Extract text from a PDF file page by page, reporting (page, pages) to `on_page`"""
+    pdf_reader = get_pypdf2().PdfReader(pdf_file)
+    pages = len(pdf_reader.pages)
+    for number, page in enumerate(pdf_reader.pages, 1):
+        text = page.extract_text()
+        if on_page:
+            on_page(number, pages)
+        yield text
 
 def extract_text_from_docx(docx_file):
-    """Extract text from a DOCX file"""
-    doc = docx.Document(docx_file)
-    text = ""
-    for paragraph in doc.paragraphs:
-        text += paragraph.text + "\n"
-    return text
+    """Extract text from a DOCX file as a stream of paragraphs"""
+    return iter_docx_text(docx_file)
+
+def extract_text_from_txt(txt_file):
+    """Extract text from a TXT file in any common encoding as a stream of chunks"""
+    return iter_txt_text(txt_file, max_bytes=TXT_MAX_BYTES)
 
 def preprocess_text(text):
-    """Preprocess text for skill extraction"""
-    # Convert to lowercase
-    text = text.lower()
+    """Preprocess text for skill extraction
+
+    Accepts either a full string or an iterable of text chunks (e.g. DOCX
+    paragraphs) so extractors can stream straight into the tokenizer.
+    """
+    from nltk.tokenize import word_tokenize
+
+    chunks = [text] if isinstance(text, str) else text
+    stop_words = get_stop_words()
+    tokens = []
+
+    for chunk in chunks:
+        # Convert to lowercase
+        chunk = chunk.lower()
+
+        # keep only letters
+        chunk = re.sub(r'[^a-zA-Z\s]', '', chunk)
+
+        # Tokenize, then remove stopwords and non-alphanumeric tokens
+        tokens.extend(token for token in word_tokenize(chunk)
+                      if token.isalnum() and token not in stop_words)
 
-    # keep only letters
-    text = re.sub(r'[^a-zA-Z\s]', '', text)
-    
-    # Tokenize
-    tokens = word_tokenize(text)
-    
-    # Remove stopwords and non-alphanumeric tokens
-    stop_words = set(stopwords.words('english'))
-    tokens = [token for token in tokens if token.isalnum() and token not in stop_words]
-    
     return tokens
 
 def extract_skills(tokens):
@@ -111,11 +169,14 @@ def extract_skills(tokens):
 
 def predict_labels(tokens):
     """Vectorizes the tokenized resume and runs it through the Random Forest Classifier and returns a list of the top 3 IT categories"""
-    processed_text = ' '.join(tokens)
-    text_vector = vectorizer.transform([processed_text])
+    profile = profiling.current()
+    with profile.stage('vectorization'):
+        processed_text = ' '.join(tokens)
+        text_vector = get_model('vectorizer').transform([processed_text])
 
-    predicted_label_encoded = model.predict_proba(text_vector)[0]
-    job_probs = list(zip(label_encoder.classes_, predicted_label_encoded))
+    with profile.stage('prediction'):
+        predicted_label_encoded = get_model('model').predict_proba(text_vector)[0]
+    job_probs = list(zip(get_model('label_encoder').classes_, predicted_label_encoded))
 
     job_probs_sorted = sorted(job_probs, key=lambda x: x[1], reverse=True)
     return job_probs_sorted[0:3]
@@ -171,38 +232,94 @@ def generate_recommendations(identified_skills, missing_skills):
     
     return recommendations
 
-@app.route('/analyze', methods=['POST'])
-def analyze_resume():
-    """Analyze a resume file"""
-    # Check if resume file is included
-    if 'resume' not in request.files:
-        return jsonify({"error": "No resume file provided"}), 400
-    
-    resume_file = request.files['resume']
-    resume_id = request.form.get('resume_id', 'unknown')
-    
-    # Check file extension
-    filename = resume_file.filename
-    if not filename:
-        return jsonify({"error": "Empty filename"}), 400
-    
+@app.route('/health', methods=['GET'])
+def health():
+    """Readiness probe used by the api_server router for failover; 503 until warm-up has finished"""
+    if not _warmed_up.is_set():
+        return jsonify({"status": "warming up"}), 503
+    return jsonify({"status": "ok"})
+
+@app.route('/startup', methods=['GET'])
+def startup():
+    """Import and lazy-load time breakdown in seconds"""
+    return jsonify(STARTUP_TIMINGS)
+
+class AnalysisError(Exception):
+    """An analysis failure carrying the HTTP status to report it with"""
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+def _error_status(error):
+    if isinstance(error, AnalysisError):
+        return error.status
+    if isinstance(error, (FileTooLargeError, MemoryLimitExceeded)):
+        return 413
+    return 500
+
+def run_analysis(resume_file, filename, resume_id, size=None, include_token_counts=False):
+    """Pick the extractor for `filename` and return the analysis pipeline as a generator of progress events
+
+    Events are dicts with a "stage" key: extracting (with page/pages for PDFs),
+    tokenizing, skills (partial results), classifying, scoring, and finally
+    done with the full "result". With `include_token_counts` the result also
+    carries the capped {token: count} map used as training data.
+    """
+    # Progress reported by the extractor, flushed after each chunk is tokenized
+    pending = []
+
+    def on_page(page, pages):
+        pending.append({"stage": "extracting", "page": page, "pages": pages})
+        profiling.current().check_limit(f'extraction (page {page} of {pages})')
+
     # Extract text based on file type
-    try:
-        if filename.lower().endswith('.pdf'):
-            text = extract_text_from_pdf(resume_file)
-        elif filename.lower().endswith('.docx'):
-            text = extract_text_from_docx(resume_file)
-        elif filename.lower().endswith('.txt'):
-            text = resume_file.read().decode('utf-8')
-        else:
-            return jsonify({"error": "Unsupported file format. Please upload PDF, DOCX, or TXT"}), 400
-        
-        # Process text to extract skills
-        tokens = preprocess_text(text)
+    name = filename.lower()
+    if name.endswith('.pdf'):
+        text = extract_text_from_pdf(resume_file, on_page=on_page)
+    elif name.endswith('.docx'):
+        text = extract_text_from_docx(resume_file)
+    elif name.endswith('.txt'):
+        text = extract_text_from_txt(resume_file)
+    else:
+        raise AnalysisError("Unsupported file format. Please upload PDF, DOCX, or TXT", 400)
+
+    def events():
+        profile = profiling.begin(resume_id, filename, size)
+        try:
+            yield from pipeline(profile)
+        finally:
+            profiling.end(profile)
+
+    def pipeline(profile):
+        yield {"stage": "extracting"}
+
+        # Process text to extract skills, one extracted chunk at a time
+        tokens = []
+        chunks = iter([text] if isinstance(text, str) else text)
+        # Allocations are counted once for the whole loop: snapshotting per
+        # chunk (one per DOCX paragraph) would make sampled requests crawl
+        with profile.allocations('extraction_and_preprocess'):
+            while True:
+                with profile.stage('extraction', count_allocations=False):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                with profile.stage('preprocess_text', count_allocations=False):
+                    tokens.extend(preprocess_text(chunk))
+                profile.check_limit('preprocess_text')
+                for event in pending:
+                    profile.pages = event["pages"]
+                    yield event
+                pending.clear()
+        yield {"stage": "tokenizing", "tokens": len(tokens)}
+
         identified_skills = extract_skills(tokens)
+        yield {"stage": "skills", "skills_identified": identified_skills}
 
+        yield {"stage": "classifying"}
         predicted_labels = predict_labels(tokens)
-        
+
+        yield {"stage": "scoring"}
         # Calculate match score
         match_score = calculate_match_score(identified_skills)
         
@@ -211,22 +328,89 @@ def analyze_resume():
         
         # Generate recommendations
         recommendations = generate_recommendations(identified_skills, missing_skills)
-        
-        # Return analysis results
-        return jsonify({
+
+        result = {
             "resume_id": resume_id,
             "predicted_labels": predicted_labels,
             "match_score": match_score,
             "skills_identified": identified_skills,
             "missing_skills": missing_skills,
             "recommendations": recommendations
-        })
+        }
+        if include_token_counts:
+            result["token_counts"] = token_counts(tokens)
+        yield {"stage": "done", "result": result}
+
+    return events()
+
+def _ndjson_progress(events):
+    """Serialize pipeline events as newline-delimited JSON, ending with an error event on failure"""
+    try:
+        for event in events:
+            yield json.dumps(event) + "\n"
     except Exception as e:
         import traceback
         print("Error during resume analysis:", e)
         traceback.print_exc()
-        return jsonify({"error": str(e)}), 500 # original
+        yield json.dumps({"stage": "error", "error": str(e), "status": _error_status(e)}) + "\n"
+
+@app.route('/analyze', methods=['POST'])
+def analyze_resume():
+    """Analyze a resume file
+
+    With a truthy `progress` form field the response is a chunked
+    application/x-ndjson stream of pipeline events instead of a single JSON body.
+    A truthy `token_counts` field adds the capped training token counts.
+    """
+    # Check if resume file is included
+    if 'resume' not in request.files:
+        return jsonify({"error": "No resume file provided"}), 400
+    
+    resume_file = request.files['resume']
+    resume_id = request.form.get('resume_id', 'unknown')
+    
+    # Check file extension
+    filename = resume_file.filename
+    if not filename:
+        return jsonify({"error": "Empty filename"}), 400
+    
+    try:
+        events = run_analysis(resume_file, filename, resume_id, size=request.content_length,
+                              include_token_counts=bool(request.form.get('token_counts')))
+        if request.form.get('progress'):
+            return Response(stream_with_context(_ndjson_progress(events)),
+                            mimetype='application/x-ndjson')
+
+        for event in events:
+            pass
+        # Return analysis results
+        return jsonify(event["result"])
+    except Exception as e:
+        status = _error_status(e)
+        if status == 500:
+            import traceback
+            print("Error during resume analysis:", e)
+            traceback.print_exc()
+        return jsonify({"error": str(e)}), status
+
+@app.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    """Worst requests by peak memory and the lines currently holding the most memory (ML_PROFILE only)"""
+    if not profiling.PROFILE_ENABLED:
+        return jsonify({"error": "Profiling is disabled; set ML_PROFILE=1"}), 404
+    return jsonify({
+        "worst_offenders": profiling.worst_offenders(),
+        "top_allocations": profiling.top_allocations()
+    })
+
+# Warm up as part of app setup so it also runs under gunicorn, but not in the
+# Werkzeug reloader's watcher process, which never serves requests
+if __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    threading.Thread(target=warm_up, daemon=True).start()
+
+mark_ready()
 
 # For direct execution
 if __name__ == '__main__':
+    print("Startup timings:", STARTUP_TIMINGS)
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,203 @@
+# ml_matcher/app/profiling.py
+"""Opt-in per-request memory profiling for the analysis pipeline
+
+ML_PROFILE=1 records the peak traced memory of every pipeline stage and, for a
+sampled fraction of requests (ML_PROFILE_SAMPLE_RATE), the number of memory
+blocks each stage left allocated. The worst requests are kept and logged.
+ML_MEMORY_LIMIT_MB aborts a request with MemoryLimitExceeded once traced
+memory has grown past the ceiling since the request started; it is checked
+between PDF pages and text chunks and when each stage ends, and turns on
+tracemalloc even without ML_PROFILE.
+
+tracemalloc traces the whole process, so with concurrent requests the numbers
+of one request include allocations made by the others at the same time, and
+resetting the peak for one request's stage clears it for the others too. The
+ceiling is therefore a process-wide soft limit: a request may be aborted
+because of its neighbours, and a single large allocation between two checks
+can overshoot it. It is not a per-request guarantee.
+"""
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+MB = 1024 * 1024
+
+PROFILE_ENABLED = os.environ.get('ML_PROFILE', '').lower() in ('1', 'true', 'yes')
+SAMPLE_RATE = float(os.environ.get('ML_PROFILE_SAMPLE_RATE', 0.1))
+MEMORY_LIMIT = int(float(os.environ.get('ML_MEMORY_LIMIT_MB', 0)) * MB)
+WORST_OFFENDERS = int(os.environ.get('ML_PROFILE_WORST', 10))
+TRACE_FRAMES = int(os.environ.get('ML_PROFILE_FRAMES', 1))
+
+
+class MemoryLimitExceeded(Exception):
+    """Raised when traced memory goes over the (process-wide, soft) ceiling during a request"""
+
+
+class RequestProfile:
+    """Peak memory, retained allocations and time per pipeline stage for one request"""
+
+    def __init__(self, resume_id, filename, size, limit=0, sample=False):
+        self.resume_id = resume_id
+        self.filename = filename
+        self.size = size
+        self.pages = None
+        self.limit = limit
+        self.sample = sample
+        self.aborted = False
+        self.stages = {}
+        self.baseline = tracemalloc.get_traced_memory()[0]
+
+    @contextmanager
+    def stage(self, name, count_allocations=True):
+        """Measure the wrapped block; stages entered repeatedly (e.g. per page) are accumulated
+
+        Counting allocations takes two full-process snapshots, so stages entered
+        once per chunk pass count_allocations=False and are counted once around
+        the whole loop with `allocations` instead.
+        """
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        with self.allocations(name) if count_allocations else nullcontext():
+            yield
+
+        peak = tracemalloc.get_traced_memory()[1] - self.baseline
+        stats = self._stats(name)
+        stats['peak_bytes'] = max(stats['peak_bytes'], peak)
+        stats['seconds'] += time.perf_counter() - start
+
+        if self.limit and peak > self.limit:
+            self._abort(peak, name)
+
+    def check_limit(self, where):
+        """Abort mid-stage if traced memory has grown past the limit since the request started"""
+        if not self.limit:
+            return
+        used = tracemalloc.get_traced_memory()[0] - self.baseline
+        if used > self.limit:
+            self._abort(used, where)
+
+    def _abort(self, used, where):
+        self.aborted = True
+        raise MemoryLimitExceeded(
+            f"Analysis used {used / MB:.1f} MB during {where}, over the {self.limit / MB:.1f} MB limit"
+        )
+
+    @contextmanager
+    def allocations(self, name):
+        """Count the memory blocks the wrapped block left allocated (sampled requests only)"""
+        if not self.sample:
+            yield
+            return
+        before = tracemalloc.take_snapshot()
+        yield
+        after = tracemalloc.take_snapshot()
+        self._stats(name)['allocations'] += sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+
+    def _stats(self, name):
+        return self.stages.setdefault(name, {'peak_bytes': 0, 'allocations': 0, 'seconds': 0.0})
+
+    @property
+    def peak_bytes(self):
+        return max((stats['peak_bytes'] for stats in self.stages.values()), default=0)
+
+    def summary(self):
+        return {
+            'resume_id': self.resume_id,
+            'filename': self.filename,
+            'size_bytes': self.size,
+            'pages': self.pages,
+            'peak_bytes': self.peak_bytes,
+            'aborted': self.aborted,
+            'sampled': self.sample,
+            'stages': {name: dict(stats, seconds=round(stats['seconds'], 4))
+                       for name, stats in self.stages.items()},
+        }
+
+
+class _NullProfile:
+    """Stand-in used when profiling is off, so call sites need no checks"""
+    pages = None
+
+    def stage(self, name, count_allocations=True):
+        return nullcontext()
+
+    def allocations(self, name):
+        return nullcontext()
+
+    def check_limit(self, where):
+        pass
+
+
+NULL_PROFILE = _NullProfile()
+
+_current = threading.local()
+_worst = []  # min-heap of (peak_bytes, seq, summary), bounded to WORST_OFFENDERS
+_worst_lock = threading.Lock()
+_seq = itertools.count()
+
+
+def is_enabled():
+    return PROFILE_ENABLED or MEMORY_LIMIT > 0
+
+
+def start_tracing():
+    """Start tracemalloc if profiling or a memory ceiling is configured"""
+    if is_enabled() and not tracemalloc.is_tracing():
+        tracemalloc.start(TRACE_FRAMES)
+
+
+def begin(resume_id, filename, size):
+    """Start profiling a request on this thread and return its profile"""
+    if not tracemalloc.is_tracing():
+        profile = NULL_PROFILE
+    else:
+        sample = PROFILE_ENABLED and random.random() < SAMPLE_RATE
+        profile = RequestProfile(resume_id, filename, size, limit=MEMORY_LIMIT, sample=sample)
+    _current.profile = profile
+    return profile
+
+
+def current():
+    """The profile of the request running on this thread (a no-op profile if none)"""
+    return getattr(_current, 'profile', NULL_PROFILE)
+
+
+def end(profile):
+    """Finish a request's profile and keep it if it is among the worst seen"""
+    _current.profile = NULL_PROFILE
+    if not isinstance(profile, RequestProfile) or not PROFILE_ENABLED:
+        return
+    summary = profile.summary()
+    with _worst_lock:
+        entry = (profile.peak_bytes, next(_seq), summary)
+        if len(_worst) < WORST_OFFENDERS:
+            heapq.heappush(_worst, entry)
+        elif entry[0] > _worst[0][0]:
+            heapq.heapreplace(_worst, entry)
+        else:
+            return
+    print("Memory profile (worst offenders):", summary)
+
+
+def worst_offenders():
+    """Profiles of the requests with the highest peak memory, worst first"""
+    with _worst_lock:
+        return [summary for _, _, summary in sorted(_worst, reverse=True)]
+
+
+def top_allocations(limit=20):
+    """Source lines currently holding the most traced memory"""
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    return [
+        {'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+         'size_bytes': stat.size, 'count': stat.count}
+        for stat in snapshot.statistics('lineno')[:limit]
+    ]
@@ -0,0 +1,23 @@
+# ml_matcher/app/startup.py
+import time
+from contextlib import contextmanager
+
+# Seconds spent on each import / lazy load, in the order they happened
+STARTUP_TIMINGS = {}
+
+_import_start = time.perf_counter()
+
+
+@contextmanager
+def timed(label):
+    """Record how long the wrapped block takes under `label` in STARTUP_TIMINGS"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMINGS[label] = round(time.perf_counter() - start, 4)
+
+
+def mark_ready():
+    """Record the total Python time from the first app import until the app is ready to serve"""
+    STARTUP_TIMINGS['ready'] = round(time.perf_counter() - _import_start, 4)
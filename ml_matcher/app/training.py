@@ -0,0 +1,205 @@
+# ml_matcher/app/training.py
+"""Retrain the job-category classifier from the analyses stored in MongoDB
+
+Each analysis stores a capped `{token: count}` map (see `token_counts`) rather
+than its full token list. Documents are streamed from Mongo in batches, hashed
+into a fixed-size sparse feature space and fed to a `partial_fit` classifier,
+so memory stays bounded by one batch and training time grows linearly with the
+number of analyses.
+
+    python -m app.training --mongo-uri mongodb://mongo:27017 [--pseudo-labels]
+
+Nothing in the app writes a reviewed `label` yet, so without labels set by hand
+only --pseudo-labels has data to train on. That mode fits the new model to the
+current model's own top predictions: its holdout "accuracy" measures agreement
+with the current model, not correctness. metadata.json records which labels a
+bundle was trained on as `label_source`.
+
+The result is a versioned bundle directory (model.pkl, vectorizer.pkl,
+label_encoder.pkl, metadata.json); point MODEL_DIR at it to serve it.
+"""
+import argparse
+import hashlib
+import json
+import os
+import pickle
+from collections import Counter
+from datetime import datetime
+
+N_FEATURES = 2 ** 18
+BATCH_SIZE = 1000
+HOLDOUT_FRACTION = 0.1
+TOP_K = 3
+# Distinct tokens kept per analysis; bounds the stored document to tens of KB
+TOKEN_COUNT_LIMIT = 2000
+
+BUNDLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model', 'bundles')
+
+
+def token_counts(tokens, limit=TOKEN_COUNT_LIMIT):
+    """Bounded training representation of a resume: its `limit` most frequent tokens with their counts
+
+    Single-letter tokens are dropped because the serving HashingVectorizer's
+    token pattern ignores them too.
+    """
+    counts = Counter(token for token in tokens if len(token) > 1)
+    return dict(counts.most_common(limit))
+
+
+def document_label(doc, pseudo_labels=False):
+    """Return the training label of an analysis: a reviewed `label`, else (optionally) its top prediction"""
+    if doc.get('label'):
+        return doc['label']
+    if pseudo_labels and doc.get('predicted_labels'):
+        return doc['predicted_labels'][0][0]
+    return None
+
+
+def is_holdout(key, fraction=HOLDOUT_FRACTION):
+    """Deterministically assign a document to the holdout set by hashing its key"""
+    bucket = int(hashlib.md5(str(key).encode('utf-8')).hexdigest()[:8], 16)
+    return bucket < fraction * 0xFFFFFFFF
+
+
+def iter_batches(documents, holdout, batch_size=BATCH_SIZE, pseudo_labels=False, fraction=HOLDOUT_FRACTION):
+    """Yield (token count maps, labels) batches from the training (or holdout) split of `documents`"""
+    counts, labels = [], []
+    for doc in documents:
+        label = document_label(doc, pseudo_labels)
+        if not label or not doc.get('token_counts'):
+            continue
+        if is_holdout(doc.get('resume_id', doc.get('_id')), fraction) != holdout:
+            continue
+        counts.append(doc['token_counts'])
+        labels.append(label)
+        if len(counts) >= batch_size:
+            yield counts, labels
+            counts, labels = [], []
+    if counts:
+        yield counts, labels
+
+
+def hash_token_counts(counts, n_features=N_FEATURES):
+    """Hash token count maps into the same l2-normalized feature space as the serving HashingVectorizer"""
+    from sklearn.feature_extraction import FeatureHasher
+    from sklearn.preprocessing import normalize
+
+    hasher = FeatureHasher(n_features=n_features, input_type='dict', alternate_sign=False)
+    return normalize(hasher.transform(counts))
+
+
+def train(document_source, classes=None, batch_size=BATCH_SIZE, pseudo_labels=False,
+          fraction=HOLDOUT_FRACTION, n_features=N_FEATURES):
+    """Train a classifier from `document_source()` (called once per pass) and evaluate it on the holdout
+
+    Returns (model, vectorizer, label_encoder, metrics).
+    """
+    import numpy as np
+    from sklearn.feature_extraction.text import HashingVectorizer
+    from sklearn.linear_model import SGDClassifier
+    from sklearn.preprocessing import LabelEncoder
+
+    if classes is None:
+        classes = {label for doc in document_source()
+                   if (label := document_label(doc, pseudo_labels))}
+    label_encoder = LabelEncoder().fit(sorted(classes))
+    all_classes = np.arange(len(label_encoder.classes_))
+
+    # Stateless vectorizer: no vocabulary to build, so a single streaming pass suffices.
+    # Training hashes the stored count maps directly; this is the equivalent text
+    # vectorizer ml_matcher uses at serving time.
+    vectorizer = HashingVectorizer(n_features=n_features, alternate_sign=False)
+    # Logistic loss keeps predict_proba available for ranking the top categories;
+    # n_jobs=-1 fits the one-vs-rest classifiers on all cores
+    model = SGDClassifier(loss='log_loss', n_jobs=-1, random_state=0)
+
+    n_train = 0
+    for counts, labels in iter_batches(document_source(), False, batch_size, pseudo_labels, fraction):
+        features = hash_token_counts(counts, n_features)
+        model.partial_fit(features, label_encoder.transform(labels), classes=all_classes)
+        n_train += len(counts)
+    if not n_train:
+        raise ValueError("No labelled analyses to train on; set `label` on analyses or use pseudo labels")
+
+    n_holdout = correct = correct_top_k = 0
+    for counts, labels in iter_batches(document_source(), True, batch_size, pseudo_labels, fraction):
+        expected = label_encoder.transform(labels)
+        probs = model.predict_proba(hash_token_counts(counts, n_features))
+        top_k = np.argsort(probs, axis=1)[:, ::-1][:, :TOP_K]
+        correct += int((top_k[:, 0] == expected).sum())
+        correct_top_k += int((top_k == expected[:, None]).any(axis=1).sum())
+        n_holdout += len(counts)
+
+    metrics = {
+        'n_train': n_train,
+        'n_holdout': n_holdout,
+        'accuracy': correct / n_holdout if n_holdout else None,
+        f'top_{TOP_K}_accuracy': correct_top_k / n_holdout if n_holdout else None,
+    }
+    return model, vectorizer, label_encoder, metrics
+
+
+def save_bundle(model, vectorizer, label_encoder, metrics, output_dir=BUNDLES_DIR, version=None,
+                label_source='label'):
+    """Write a versioned model bundle in the layout ml_matcher loads and return its path
+
+    `label_source` is 'label' for reviewed labels only, or 'label+predicted_labels'
+    when pseudo labels were used (metrics then measure agreement with the old model).
+    """
+    version = version or datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    bundle_dir = os.path.join(output_dir, version)
+    os.makedirs(bundle_dir, exist_ok=False)
+
+    for name, obj in (('model', model), ('vectorizer', vectorizer), ('label_encoder', label_encoder)):
+        with open(os.path.join(bundle_dir, f'{name}.pkl'), 'wb') as f:
+            pickle.dump(obj, f)
+    with open(os.path.join(bundle_dir, 'metadata.json'), 'w') as f:
+        json.dump({
+            'version': version,
+            'classes': list(label_encoder.classes_),
+            'label_source': label_source,
+            'metrics': metrics,
+        }, f, indent=2)
+    return bundle_dir
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Retrain the job-category classifier from stored analyses")
+    parser.add_argument('--mongo-uri', default=os.environ.get('MONGO_URI', 'mongodb://mongo:27017'))
+    parser.add_argument('--db', default='resume_analyzer')
+    parser.add_argument('--output-dir', default=BUNDLES_DIR)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--holdout', type=float, default=HOLDOUT_FRACTION)
+    parser.add_argument('--pseudo-labels', action='store_true',
+                        help="use each analysis' top predicted category when it has no reviewed label")
+    args = parser.parse_args(argv)
+
+    import pymongo
+
+    analyses = pymongo.MongoClient(args.mongo_uri)[args.db].analyses
+    projection = {'resume_id': 1, 'token_counts': 1, 'label': 1, 'predicted_labels': 1}
+
+    def document_source():
+        return analyses.find({'token_counts': {'$exists': True}}, projection, batch_size=args.batch_size)
+
+    # Ask Mongo for the classes instead of an extra pass over every analysis
+    classes = set(analyses.distinct('label')) - {None, ''}
+    if args.pseudo_labels:
+        top_prediction = {'$arrayElemAt': [{'$arrayElemAt': ['$predicted_labels', 0]}, 0]}
+        classes |= {group['_id'] for group in analyses.aggregate([{'$group': {'_id': top_prediction}}])} - {None, ''}
+
+    model, vectorizer, label_encoder, metrics = train(
+        document_source,
+        classes=classes,
+        batch_size=args.batch_size,
+        pseudo_labels=args.pseudo_labels,
+        fraction=args.holdout,
+    )
+    label_source = 'label+predicted_labels' if args.pseudo_labels else 'label'
+    bundle_dir = save_bundle(model, vectorizer, label_encoder, metrics, args.output_dir,
+                             label_source=label_source)
+    print(f"Saved bundle to {bundle_dir}: {json.dumps(metrics)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -60,8 +60,13 @@ from app.main import (
     predict_labels,
     SKILL_DATABASE
 )
+from app.extractors import iter_docx_text, iter_txt_text, sniff_text_encoding
+from app import training, profiling
+import tracemalloc
+import zipfile
+import json
 import pytest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 SKILL_DATABASE.setdefault("databases", []).append("SQL")
 
@@ -140,6 +145,76 @@ def test_analyze_resume_txt(client):
     for skill in ("React","MongoDB"):
         assert skill in j['skills_identified']
 
+def test_health_reports_readiness(client):
+    _m._warmed_up.clear()
+    r = client.get('/health')
+    assert r.status_code == 503
+    _m.warm_up()
+    r = client.get('/health')
+    assert r.status_code == 200
+    assert r.get_json() == {"status": "ok"}
+
+def test_pypdf2_import_timed_once(client):
+    _m.get_pypdf2()
+    _m.STARTUP_TIMINGS['import PyPDF2'] = first = 1.5
+    data = {'resume': (io.BytesIO(b"%PDF"), 'resume.pdf')}
+    assert client.post('/analyze', data=data, content_type='multipart/form-data').status_code == 200
+    assert _m.STARTUP_TIMINGS['import PyPDF2'] == first
+
+def test_startup_timings(client):
+    r = client.get('/startup')
+    assert r.status_code == 200
+    assert 'ready' in r.get_json()
+
+def test_get_model_loads_once():
+    vectorizer = _m.get_model('vectorizer')
+    assert isinstance(vectorizer, _DummyVectorizer)
+    assert _m.get_model('vectorizer') is vectorizer
+    assert 'load vectorizer.pkl' in _m.STARTUP_TIMINGS
+
+def test_analyze_resume_progress_stream(client, monkeypatch):
+    pages = [types.SimpleNamespace(extract_text=lambda: "Python"),
+             types.SimpleNamespace(extract_text=lambda: "Docker")]
+    monkeypatch.setattr(sys.modules['PyPDF2'], 'PdfReader',
+                        lambda f: types.SimpleNamespace(pages=pages))
+    data = {
+        'resume_id': 'test-id',
+        'progress': '1',
+        'resume': (io.BytesIO(b"%PDF"), 'resume.pdf'),
+    }
+    r = client.post('/analyze', data=data, content_type='multipart/form-data')
+    assert r.status_code == 200
+    assert r.mimetype == 'application/x-ndjson'
+    events = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+    stages = [e['stage'] for e in events]
+    assert stages == ['extracting', 'extracting', 'extracting', 'tokenizing',
+                      'skills', 'classifying', 'scoring', 'done']
+    assert events[2] == {'stage': 'extracting', 'page': 2, 'pages': 2}
+    assert sorted(events[4]['skills_identified']) == ['Docker', 'Python']
+    assert events[-1]['result']['resume_id'] == 'test-id'
+    assert 'token_counts' not in events[-1]['result']
+    assert 'tokens' not in events[-1]['result']
+
+def test_analyze_resume_token_counts_on_request(client):
+    data = {
+        'resume_id': 'test-id',
+        'token_counts': '1',
+        'resume': (io.BytesIO(b"Python python SQL"), 'resume.txt'),
+    }
+    r = client.post('/analyze', data=data, content_type='multipart/form-data')
+    assert r.status_code == 200
+    assert r.get_json()['token_counts'] == {'python': 2, 'sql': 1}
+
+def test_analyze_resume_progress_stream_error(client):
+    data = {
+        'progress': '1',
+        'resume': (io.BytesIO(b"not a zip"), 'resume.docx'),
+    }
+    r = client.post('/analyze', data=data, content_type='multipart/form-data')
+    events = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+    assert events[-1]['stage'] == 'error'
+    assert events[-1]['status'] == 500
+
 def test_analyze_resume_no_file(client):
     r = client.post('/analyze',
                     data={'resume_id': 'test-id'},
@@ -155,3 +230,255 @@ def test_analyze_resume_unsupported_format(client):
                     data=data,
                     content_type='multipart/form-data')
     assert r.status_code == 400
+
+
+_W_NS = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+_MC_NS = 'xmlns:mc="http://schemas.openxmlformats.org/markup-compatibility/2006"'
+
+def _make_docx(body, header=None):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as z:
+        z.writestr('word/document.xml',
+                   f'<w:document {_W_NS} {_MC_NS}><w:body>{body}</w:body></w:document>')
+        if header is not None:
+            z.writestr('word/header1.xml', f'<w:hdr {_W_NS}>{header}</w:hdr>')
+    buf.seek(0)
+    return buf
+
+def test_iter_docx_text_paragraphs_tables_headers():
+    body = (
+        '<w:p><w:r><w:t>Skilled in Pyt</w:t></w:r><w:r><w:t>hon</w:t></w:r></w:p>'
+        '<w:tbl><w:tr><w:tc><w:p><w:r><w:t>Docker</w:t></w:r></w:p></w:tc></w:tr></w:tbl>'
+    )
+    header = '<w:p><w:r><w:t>Jane Doe</w:t></w:r></w:p>'
+    chunks = list(iter_docx_text(_make_docx(body, header)))
+    assert chunks == ["Jane Doe\n", "Skilled in Python\n", "Docker\n"]
+
+def test_iter_docx_text_reads_text_boxes_once():
+    box = '<w:txbxContent><w:p><w:r><w:t>AWS</w:t></w:r></w:p></w:txbxContent>'
+    body = (
+        '<w:p><w:r><mc:AlternateContent>'
+        f'<mc:Choice>{box}</mc:Choice><mc:Fallback>{box}</mc:Fallback>'
+        '</mc:AlternateContent></w:r></w:p>'
+    )
+    assert list(iter_docx_text(_make_docx(body))) == ["AWS\n"]
+
+def test_iter_docx_text_memory_does_not_grow_with_tables():
+    def peak_for(rows):
+        row = '<w:tr><w:tc><w:tcPr><w:tcW w:w="100"/></w:tcPr><w:p><w:r><w:t>Go</w:t></w:r></w:p></w:tc></w:tr>'
+        docx = _make_docx(f'<w:tbl>{row * rows}</w:tbl>')
+        tracemalloc.start()
+        try:
+            assert sum(1 for _ in iter_docx_text(docx)) == rows
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    assert peak_for(20000) < 2 * peak_for(2000)
+
+def test_preprocess_text_accepts_chunks():
+    toks = preprocess_text(["Python and\n", "Docker\n"])
+    assert toks == ["python", "docker"]
+
+def test_analyze_resume_docx_streaming(client):
+    body = '<w:p><w:r><w:t>MongoDB</w:t></w:r></w:p>'
+    data = {
+        'resume_id': 'test-id',
+        'resume': (_make_docx(body), 'resume.docx'),
+    }
+    r = client.post('/analyze', data=data, content_type='multipart/form-data')
+    assert r.status_code == 200
+    assert 'MongoDB' in r.get_json()['skills_identified']
+
+@pytest.mark.parametrize("raw,encoding", [
+    ("Python résumé".encode("utf-8"), "utf-8"),
+    ("Python résumé".encode("utf-8-sig"), "utf-8-sig"),
+    ("Python résumé".encode("utf-16"), "utf-16"),
+    ("Python résumé".encode("utf-16-le"), "utf-16-le"),
+    ("Python résumé".encode("latin-1"), "cp1252"),
+])
+def test_sniff_text_encoding(raw, encoding):
+    assert sniff_text_encoding(raw) == encoding
+
+def test_iter_txt_text_keeps_words_across_chunks():
+    raw = ("Python Docker " * 400).encode("utf-16")
+    chunks = list(iter_txt_text(io.BytesIO(raw), chunk_size=7))
+    assert "".join(chunks) == "Python Docker " * 400
+    assert all(c.endswith(" ") for c in chunks)
+
+def test_analyze_resume_txt_latin1(client):
+    data = {
+        'resume_id': 'test-id',
+        'resume': (io.BytesIO("Résumé: React, MongoDB".encode("latin-1")), 'resume.txt'),
+    }
+    r = client.post('/analyze', data=data, content_type='multipart/form-data')
+    assert r.status_code == 200
+    assert 'React' in r.get_json()['skills_identified']
+
+def test_analyze_resume_txt_too_large(client, monkeypatch):
+    monkeypatch.setattr(_m, 'TXT_MAX_BYTES', 10)
+    data = {
+        'resume_id': 'test-id',
+        'resume': (io.BytesIO(b"Python " * 10), 'resume.txt'),
+    }
+    r = client.post('/analyze', data=data, content_type='multipart/form-data')
+    assert r.status_code == 413
+
+def _training_docs():
+    docs = []
+    for i in range(400):
+        if i % 2:
+            docs.append({"resume_id": f"r{i}", "token_counts": {"python": 2, "pandas": 1, "numpy": 1}, "label": "DATA"})
+        else:
+            docs.append({"resume_id": f"r{i}", "token_counts": {"react": 1, "css": 3, "html": 1},
+                         "predicted_labels": [["WEB", 0.9], ["DATA", 0.1]]})
+    docs.append({"resume_id": "unlabelled", "token_counts": {"go": 1}})
+    return docs
+
+def test_document_label():
+    assert training.document_label({"label": "DATA"}) == "DATA"
+    assert training.document_label({"predicted_labels": [["WEB", 0.9]]}) is None
+    assert training.document_label({"predicted_labels": [["WEB", 0.9]]}, pseudo_labels=True) == "WEB"
+
+def test_train_streams_batches_and_evaluates_holdout():
+    docs = _training_docs()
+    model, vectorizer, label_encoder, metrics = training.train(
+        lambda: iter(docs), batch_size=32, pseudo_labels=True)
+    assert list(label_encoder.classes_) == ["DATA", "WEB"]
+    assert metrics["n_train"] + metrics["n_holdout"] == 400
+    assert 0 < metrics["n_holdout"] < 100
+    assert metrics["accuracy"] == 1.0
+
+def test_train_requires_labels():
+    with pytest.raises(ValueError):
+        training.train(lambda: iter([{"resume_id": "x", "token_counts": {"go": 1}}]), classes=["A"])
+
+def test_token_counts_are_capped():
+    counts = training.token_counts(["python"] * 3 + ["sql", "a"] + [f"t{i}" for i in range(10)], limit=2)
+    assert counts == {"python": 3, "sql": 1}
+
+def test_hashed_token_counts_match_serving_vectorizer():
+    from sklearn.feature_extraction.text import HashingVectorizer
+    tokens = ["python", "pandas", "python", "sql", "data"]
+    vectorizer = HashingVectorizer(n_features=2 ** 10, alternate_sign=False)
+    expected = vectorizer.transform([" ".join(tokens)]).toarray()
+    hashed = training.hash_token_counts([training.token_counts(tokens)], n_features=2 ** 10).toarray()
+    assert (abs(hashed - expected) < 1e-9).all()
+
+def test_save_bundle(tmp_path):
+    docs = _training_docs()
+    bundle = training.save_bundle(*training.train(lambda: iter(docs), classes={"DATA", "WEB"}, pseudo_labels=True),
+                                  output_dir=str(tmp_path), version="v1", label_source="label+predicted_labels")
+    assert sorted(os.listdir(bundle)) == ["label_encoder.pkl", "metadata.json", "model.pkl", "vectorizer.pkl"]
+    with open(os.path.join(bundle, "metadata.json")) as f:
+        assert json.load(f)["label_source"] == "label+predicted_labels"
+
+def test_training_main_reads_classes_from_mongo(tmp_path, monkeypatch):
+    docs = _training_docs()
+    analyses = MagicMock()
+    analyses.find.side_effect = lambda *a, **k: iter(docs)
+    analyses.distinct.return_value = ["DATA"]
+    analyses.aggregate.return_value = [{"_id": "WEB"}, {"_id": "DATA"}]
+    mongo = types.ModuleType('pymongo')
+    mongo.MongoClient = lambda uri: {"resume_analyzer": types.SimpleNamespace(analyses=analyses)}
+    monkeypatch.setitem(sys.modules, 'pymongo', mongo)
+
+    training.main(["--output-dir", str(tmp_path), "--pseudo-labels"])
+    # One pass for training and one for the holdout; classes come from Mongo
+    assert analyses.find.call_count == 2
+    analyses.distinct.assert_called_once_with('label')
+    (bundle,) = os.listdir(tmp_path)
+    with open(os.path.join(tmp_path, bundle, "metadata.json")) as f:
+        metadata = json.load(f)
+    assert metadata["classes"] == ["DATA", "WEB"]
+    assert metadata["label_source"] == "label+predicted_labels"
+
+@pytest.fixture
+def tracing(monkeypatch):
+    monkeypatch.setattr(profiling, '_worst', [])
+    tracemalloc.start()
+    yield monkeypatch
+    tracemalloc.stop()
+
+def test_debug_profile_disabled(client):
+    assert client.get('/debug/profile').status_code == 404
+
+def test_profile_records_stages(client, tracing):
+    tracing.setattr(profiling, 'PROFILE_ENABLED', True)
+    tracing.setattr(profiling, 'SAMPLE_RATE', 1.0)
+    data = {
+        'resume_id': 'big-id',
+        'resume': (io.BytesIO(b"React MongoDB " * 100), 'resume.txt'),
+    }
+    assert client.post('/analyze', data=data, content_type='multipart/form-data').status_code == 200
+
+    r = client.get('/debug/profile')
+    assert r.status_code == 200
+    worst = r.get_json()['worst_offenders']
+    assert worst[0]['resume_id'] == 'big-id'
+    assert worst[0]['sampled'] is True
+    assert {'extraction', 'preprocess_text'} <= set(worst[0]['stages'])
+    assert worst[0]['size_bytes'] > 1400
+    assert r.get_json()['top_allocations']
+
+def test_sampled_profile_snapshots_once_per_loop(client, tracing, monkeypatch):
+    tracing.setattr(profiling, 'PROFILE_ENABLED', True)
+    tracing.setattr(profiling, 'SAMPLE_RATE', 1.0)
+    snapshots = []
+    take_snapshot = tracemalloc.take_snapshot
+    monkeypatch.setattr(profiling.tracemalloc, 'take_snapshot',
+                        lambda: snapshots.append(1) or take_snapshot())
+    pages = [types.SimpleNamespace(extract_text=lambda: "Python") for _ in range(20)]
+    monkeypatch.setattr(sys.modules['PyPDF2'], 'PdfReader',
+                        lambda f: types.SimpleNamespace(pages=pages))
+    data = {
+        'resume_id': 'test-id',
+        'resume': (io.BytesIO(b"%PDF"), 'resume.pdf'),
+    }
+    assert client.post('/analyze', data=data, content_type='multipart/form-data').status_code == 200
+    # predict_labels is stubbed here, so only the extraction loop is snapshotted
+    assert len(snapshots) == 2
+    stages = profiling.worst_offenders()[0]['stages']
+    assert {'extraction', 'preprocess_text', 'extraction_and_preprocess'} <= set(stages)
+
+def test_memory_limit_aborts_request(client, tracing):
+    tracing.setattr(profiling, 'MEMORY_LIMIT', 1)
+    data = {
+        'resume_id': 'test-id',
+        'resume': (io.BytesIO(b"Python " * 1000), 'resume.txt'),
+    }
+    r = client.post('/analyze', data=data, content_type='multipart/form-data')
+    assert r.status_code == 413
+    assert 'limit' in r.get_json()['error']
+    assert profiling.current() is profiling.NULL_PROFILE
+
+def test_memory_limit_checked_between_pages(client, tracing, monkeypatch):
+    tracing.setattr(profiling, 'MEMORY_LIMIT', 1)
+    extracted = []
+
+    def page(number):
+        def extract_text():
+            extracted.append(number)
+            return "x" * 10000
+        return types.SimpleNamespace(extract_text=extract_text)
+
+    pages = [page(n) for n in range(1, 4)]
+    monkeypatch.setattr(sys.modules['PyPDF2'], 'PdfReader',
+                        lambda f: types.SimpleNamespace(pages=pages))
+    data = {
+        'resume_id': 'test-id',
+        'resume': (io.BytesIO(b"%PDF"), 'resume.pdf'),
+    }
+    r = client.post('/analyze', data=data, content_type='multipart/form-data')
+    assert r.status_code == 413
+    assert 'page 1 of 3' in r.get_json()['error']
+    assert extracted == [1]
+
+def test_request_profile_accumulates_repeated_stages(tracing):
+    profile = profiling.RequestProfile('id', 'r.txt', 10)
+    for _ in range(3):
+        with profile.stage('extraction'):
+            blob = [0] * 10000
+    del blob
+    assert profile.stages['extraction']['peak_bytes'] > 0
+    assert profile.summary()['peak_bytes'] == profile.stages['extraction']['peak_bytes']